@@ -0,0 +1,365 @@
+# pyright: reportUnknownMemberType=false
+# pyright: reportUnknownVariableType=false
+# pyright: reportUnknownArgumentType=false
+# pyright: reportAttributeAccessIssue=false
+"""Offline benchmarks against synthetic update images
+
+Generates a CrAU payload and a swupdate archive holding the same image, a
+mix of empty, repetitive and random blocks rather than a real ext4 file
+system, then measures both readers. sequential_peak_memory comes from
+tracemalloc, so it only covers the sequential read and misses allocations
+made in C by bz2, zlib and indexed_gzip. Results are written as JSON lines,
+one object per measurement, and can be compared against a previous run:
+
+    python bench.py > bench_output.txt
+    python bench.py --baseline bench_output.txt
+"""
+
+import argparse
+import bz2
+import gzip
+import hashlib
+import json
+import os
+import random
+import struct
+import sys
+import time
+import tracemalloc
+from statistics import median, quantiles
+from tempfile import TemporaryDirectory
+from typing import TextIO, cast
+
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
+from cryptography.hazmat.primitives.asymmetric.utils import Prehashed
+from cryptography.hazmat.primitives.hashes import SHA256
+from cryptography.hazmat.primitives.serialization import (
+    Encoding,
+    PublicFormat,
+)
+
+from remarkable_update_image import UpdateImage
+from remarkable_update_image.image import (
+    CPIOUpdateImage,
+    ProtobufUpdateImage,
+)
+from remarkable_update_image.update_metadata_pb2 import (
+    DeltaArchiveManifest,
+    Signatures,
+)
+
+BLOCK_SIZE = 4096
+# Blob sizes from a single block up to 2MiB
+BLOB_BLOCKS = (1, 2, 8, 32, 128, 512)
+READ_SIZE = 4096
+CHUNK_SIZE = 1024 * 1024
+
+
+def make_image(size: int, seed: int = 1) -> bytes:
+    """Mix of empty, repetitive and random blocks, roughly like a rootfs"""
+    rnd = random.Random(seed)  # noqa: S311
+    image = bytearray()
+    for index in range(size // BLOCK_SIZE):
+        kind = rnd.random()
+        if kind < 0.3:
+            image += bytes(BLOCK_SIZE)
+
+        elif kind < 0.6:
+            image += bytes([index % 256]) * BLOCK_SIZE
+
+        else:
+            image += rnd.randbytes(BLOCK_SIZE)
+
+    return bytes(image)
+
+
+def make_crau(path: str, image: bytes, key: rsa.RSAPrivateKey, seed: int = 2) -> None:
+    """Write image as a signed CrAU payload of REPLACE and REPLACE_BZ blobs"""
+    rnd = random.Random(seed)  # noqa: S311
+    manifest = DeltaArchiveManifest()
+    manifest.block_size = BLOCK_SIZE
+    data = bytearray()
+    blocks = len(image) // BLOCK_SIZE
+    block = 0
+    while block < blocks:
+        count = min(rnd.choice(BLOB_BLOCKS), blocks - block)
+        chunk = image[block * BLOCK_SIZE : (block + count) * BLOCK_SIZE]
+        operation = manifest.partition_operations.add()
+        if rnd.random() < 0.5:
+            operation.type = 1
+            payload = bz2.compress(chunk)
+
+        else:
+            operation.type = 0
+            payload = chunk
+
+        operation.data_offset = len(data)
+        operation.data_length = len(payload)
+        operation.data_sha256_hash = hashlib.sha256(payload).digest()
+        extent = operation.dst_extents.add()
+        extent.start_block = block
+        extent.num_blocks = count
+        data += payload
+        block += count
+
+    signature_size = key.key_size // 8
+    placeholder = Signatures()
+    placeholder.signatures.add(version=2, data=bytes(signature_size))
+    manifest.signatures_offset = len(data)
+    manifest.signatures_size = placeholder.ByteSize()
+    header = manifest.SerializeToString()
+    signed = b"CrAU" + struct.pack(">QQ", 1, len(header)) + header + data
+    signatures = Signatures()
+    signatures.signatures.add(
+        version=2,
+        data=key.sign(hashlib.sha256(signed).digest(), PKCS1v15(), Prehashed(SHA256())),
+    )
+    with open(path, "wb") as f:
+        _ = f.write(signed)
+        _ = f.write(signatures.SerializeToString())
+
+
+def _newc(name: bytes, data: bytes, ino: int) -> bytes:
+    fields = (ino, 0o100644, 0, 0, 1, 0, len(data), 0, 0, 0, 0, len(name) + 1, 0)
+    entry = b"070701" + b"".join(f"{x:08X}".encode() for x in fields)
+    entry += name + b"\x00"
+    entry += bytes(-len(entry) % 4)
+    return entry + data + bytes(-len(data) % 4)
+
+
+def make_swu(
+    path: str,
+    image: bytes,
+    key: rsa.RSAPrivateKey,
+    *,
+    members: int = 1,
+    other: bytes | None = None,
+) -> None:
+    """Write image, and other after it, as a signed swupdate of gzip members"""
+    step = -(-len(image) // members)
+    compressed = b"".join(
+        gzip.compress(image[x : x + step], compresslevel=6)
+        for x in range(0, len(image), step)
+    )
+    files = {b"rootfs.ext4.gz": compressed}
+    if other is not None:
+        files[b"other.ext4.gz"] = gzip.compress(other, compresslevel=6)
+
+    entries: list[str] = []
+    for name, data in files.items():
+        digest = hashlib.sha256(data).hexdigest()
+        entries.append(f'{{ filename = "{name.decode()}"; sha256 = "{digest}"; }}')
+
+    images = f"images = ( {', '.join(entries)} );"
+    description = f"""software = {{
+  version = "3.0.0.0";
+  reMarkable2 = {{
+    stable = {{
+      copy1 = {{ {images} }};
+      copy2 = {{ {images} }};
+    }};
+  }};
+}};
+""".encode()
+    with open(path, "wb") as f:
+        _ = f.write(_newc(b"sw-description", description, 1))
+        _ = f.write(
+            _newc(
+                b"sw-description.sig",
+                key.sign(description, PKCS1v15(), SHA256()),
+                2,
+            )
+        )
+        for ino, (name, data) in enumerate(files.items(), 3):
+            _ = f.write(_newc(name, data, ino))
+
+        _ = f.write(_newc(b"TRAILER!!!", b"", 0))
+
+
+def bench_open(path: str, repeat: int) -> float:
+    """Median seconds to open path"""
+    timings: list[float] = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        image = UpdateImage(path)
+        timings.append(time.perf_counter() - start)
+        image.close()
+
+    return median(timings)
+
+
+def bench_random_reads(path: str, count: int) -> tuple[float, float]:
+    """Median and 99th percentile seconds of small reads at random offsets"""
+    rnd = random.Random(3)  # noqa: S311
+    timings: list[float] = []
+    with UpdateImage(path) as image:
+        size = image.size
+        for _ in range(count):
+            offset = rnd.randrange(0, size - READ_SIZE)
+            start = time.perf_counter()
+            _ = image.read_at(offset, READ_SIZE)
+            timings.append(time.perf_counter() - start)
+
+    return median(timings), quantiles(timings, n=100)[98]
+
+
+def bench_sequential(path: str) -> tuple[float, int]:
+    """Bytes per second of a full sequential read and its peak Python memory"""
+    with UpdateImage(path) as image:
+        size = image.size
+        tracemalloc.start()
+        start = time.perf_counter()
+        while image.read(CHUNK_SIZE):
+            pass
+
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+
+    return size / elapsed, peak
+
+
+def bench_verify(path: str, publickey: bytes) -> float:
+    with UpdateImage(path) as image:
+        start = time.perf_counter()
+        image.verify(publickey)
+        return time.perf_counter() - start
+
+
+def bench_verify_blobs(path: str) -> float:
+    with UpdateImage(path) as image:
+        assert isinstance(image, ProtobufUpdateImage)
+        start = time.perf_counter()
+        if not all(image.verify_blobs().values()):
+            raise RuntimeError(f"{path} has corrupt blobs")
+
+        return time.perf_counter() - start
+
+
+def run(size: int, repeat: int, reads: int, output: TextIO) -> list[dict[str, object]]:
+    results: list[dict[str, object]] = []
+
+    def record(fmt: str, name: str, value: float, unit: str, better: str) -> None:
+        result: dict[str, object] = {
+            "format": fmt,
+            "benchmark": name,
+            "value": value,
+            "unit": unit,
+            "better": better,
+        }
+        results.append(result)
+        print(json.dumps(result), file=output, flush=True)
+
+    key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    publickey = key.public_key().public_bytes(
+        Encoding.PEM, PublicFormat.SubjectPublicKeyInfo
+    )
+    image = make_image(size * 1024 * 1024)
+    with TemporaryDirectory() as tmp:
+        paths = {
+            "crau": os.path.join(tmp, "update.signed"),
+            "swu": os.path.join(tmp, "update.swu"),
+        }
+        make_crau(paths["crau"], image, key)
+        make_swu(paths["swu"], image, key)
+        for fmt, path in paths.items():
+            with UpdateImage(path) as update:
+                expected = ProtobufUpdateImage if fmt == "crau" else CPIOUpdateImage
+                assert isinstance(update, expected)
+
+            record(fmt, "open", bench_open(path, repeat), "s", "lower")
+            p50, p99 = bench_random_reads(path, reads)
+            record(fmt, "random_read_p50", p50, "s", "lower")
+            record(fmt, "random_read_p99", p99, "s", "lower")
+            throughput, peak = bench_sequential(path)
+            record(fmt, "sequential", throughput, "B/s", "higher")
+            record(fmt, "sequential_peak_memory", peak, "B", "lower")
+            record(fmt, "verify", bench_verify(path, publickey), "s", "lower")
+            if fmt == "crau":
+                record(fmt, "verify_blobs", bench_verify_blobs(path), "s", "lower")
+
+    return results
+
+
+def compare(results: list[dict[str, object]], baseline: str, threshold: float) -> bool:
+    """Report results worse than baseline by more than threshold"""
+    previous: dict[tuple[object, object], float] = {}
+    with open(baseline) as f:
+        for line in f:
+            if line.strip():
+                result = cast(dict[str, object], json.loads(line))
+                previous[result["format"], result["benchmark"]] = cast(
+                    float, result["value"]
+                )
+
+    ok = True
+    for result in results:
+        old = previous.get((result["format"], result["benchmark"]))
+        value = result["value"]
+        if old is None or not old or not isinstance(value, float | int):
+            continue
+
+        change = value / old - 1
+        if result["better"] == "higher":
+            change = -change
+
+        if change > threshold:
+            ok = False
+            print(
+                f"regression: {result['format']} {result['benchmark']} "
+                + f"{old:.6g} -> {value:.6g} {result['unit']} ({change:+.0%})",
+                file=sys.stderr,
+            )
+
+    return ok
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(
+        description="Offline benchmarks against synthetic update images"
+    )
+    _ = parser.add_argument(
+        "--size", type=int, default=64, help="Image size in MiB (default: 64)"
+    )
+    _ = parser.add_argument(
+        "--repeat", type=int, default=5, help="Opens to time (default: 5)"
+    )
+    _ = parser.add_argument(
+        "--reads", type=int, default=200, help="Random reads to time (default: 200)"
+    )
+    _ = parser.add_argument(
+        "--output",
+        help="Where to write the results (default: stdout)",
+    )
+    _ = parser.add_argument(
+        "--baseline", help="Results of a previous run to compare against"
+    )
+    _ = parser.add_argument(
+        "--threshold",
+        type=float,
+        default=0.25,
+        help="Allowed slowdown against the baseline (default: 0.25)",
+    )
+    args = parser.parse_args()
+    size = cast(int, args.size)
+    repeat = cast(int, args.repeat)
+    reads = cast(int, args.reads)
+    output = cast(str | None, args.output)
+    baseline = cast(str | None, args.baseline)
+    threshold = cast(float, args.threshold)
+    if output is None:
+        results = run(size, repeat, reads, sys.stdout)
+
+    else:
+        with open(output, "w") as f:
+            results = run(size, repeat, reads, f)
+
+    if baseline is not None and not compare(results, baseline, threshold):
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,12 +1,23 @@
-from .cpio import Archive, ChecksumError, Entry, MagicError
+from .aio import AsyncUpdateImage
+from .cpio import (
+    Archive,
+    ChecksumError,
+    Entry,
+    MagicError,
+    StreamEntry,
+    iter_entries,
+)
 from .image import UpdateImage, UpdateImageException, UpdateImageSignatureException
 
 __all__ = [
     "Archive",
+    "AsyncUpdateImage",
     "ChecksumError",
     "Entry",
     "MagicError",
+    "StreamEntry",
     "UpdateImage",
     "UpdateImageException",
     "UpdateImageSignatureException",
+    "iter_entries",
 ]
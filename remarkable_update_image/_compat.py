@@ -5,15 +5,17 @@
 # pyright: reportAny=false
 import os
 import sys
+import threading
 from typing import (
     Protocol,
     runtime_checkable,
 )
 
 if sys.version_info < (3, 12):
-    from typing_extensions import override
+    from typing_extensions import Buffer, override
 
 else:
+    from collections.abc import Buffer
     from typing import override
 
 
@@ -28,4 +30,69 @@ class FileObj(Protocol):
     def close(self) -> None: ...
 
 
-__all__ = ["FileObj", "override"]
+@runtime_checkable
+class StreamObj(Protocol):
+    def read(self, size: int | None = -1, /) -> bytes: ...
+
+
+if hasattr(os, "pread"):
+
+    def _pread(fd: int, size: int, offset: int) -> bytes:
+        return os.pread(fd, size, offset)
+
+else:
+    _pread_lock = threading.Lock()
+
+    def _pread(fd: int, size: int, offset: int) -> bytes:
+        with _pread_lock:
+            _ = os.lseek(fd, offset, os.SEEK_SET)
+            return os.read(fd, size)
+
+
+def pread(fd: int, size: int, offset: int) -> bytes:
+    data = _pread(fd, size, offset)
+    while 0 < len(data) < size:
+        chunk = _pread(fd, size - len(data), offset + len(data))
+        if not chunk:
+            break
+
+        data += chunk
+
+    return data
+
+
+if hasattr(os, "pwrite"):
+
+    def _pwrite(fd: int, data: bytes | memoryview, offset: int) -> int:
+        return os.pwrite(fd, data, offset)
+
+else:
+    _pwrite_lock = threading.Lock()
+
+    def _pwrite(fd: int, data: bytes | memoryview, offset: int) -> int:
+        with _pwrite_lock:
+            _ = os.lseek(fd, offset, os.SEEK_SET)
+            return os.write(fd, data)
+
+
+def pwrite(fd: int, data: bytes | memoryview, offset: int) -> None:
+    view = memoryview(data)
+    while view:
+        written = _pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def open_fd(path: str) -> int:
+    return os.open(path, os.O_RDONLY | getattr(os, "O_BINARY", 0))
+
+
+__all__ = [
+    "Buffer",
+    "FileObj",
+    "StreamObj",
+    "open_fd",
+    "override",
+    "pread",
+    "pwrite",
+]
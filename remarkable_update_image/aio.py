@@ -0,0 +1,114 @@
+import asyncio
+import functools
+import os
+from collections.abc import Callable
+from concurrent.futures import Executor
+from types import TracebackType
+from typing import (
+    Any,
+    Self,
+    TypeVar,
+)
+
+from .image import (
+    CPIOUpdateImage,
+    ProtobufUpdateImage,
+    UpdateImage,
+)
+
+T = TypeVar("T")
+
+
+class AsyncUpdateImage:
+    """asyncio counterpart of UpdateImage, blocking work runs in executor"""
+
+    def __init__(
+        self,
+        image: ProtobufUpdateImage | CPIOUpdateImage,
+        executor: Executor | None = None,
+    ) -> None:
+        self._image: ProtobufUpdateImage | CPIOUpdateImage = image
+        self._executor: Executor | None = executor
+        self._pos: int = 0
+
+    @classmethod
+    async def open(
+        cls,
+        update_file: str,
+        executor: Executor | None = None,
+        **kwargs: Any,  # pyright: ignore[reportAny, reportExplicitAny]
+    ) -> Self:
+        """Open update_file in executor, kwargs are passed to UpdateImage"""
+        loop = asyncio.get_running_loop()
+        image = await loop.run_in_executor(
+            executor,
+            functools.partial(UpdateImage, update_file, **kwargs),
+        )
+        return cls(image, executor)
+
+    async def __aenter__(self) -> Self:
+        return self
+
+    async def __aexit__(
+        self,
+        exc_type: type[BaseException] | None,
+        exc_value: BaseException | None,
+        traceback: TracebackType | None,
+    ) -> None:
+        await self.close()
+
+    @property
+    def image(self) -> ProtobufUpdateImage | CPIOUpdateImage:
+        return self._image
+
+    async def _run(self, func: Callable[..., T], *args: object) -> T:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    async def read_at(self, offset: int, size: int) -> bytes:
+        """Read up to size bytes at offset without using the cursor"""
+        return await self._run(self._image.read_at, offset, size)
+
+    async def read(self, size: int = -1) -> bytes:
+        data = await self.peek(size)
+        self._pos += len(data)
+        return data
+
+    async def peek(self, size: int = 0) -> bytes:
+        """Return up to size bytes at the cursor, the rest of the image if 0"""
+        if size <= 0:
+            size = max(await self.size() - self._pos, 0)
+
+        return await self.read_at(self._pos, size)
+
+    async def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        if whence == os.SEEK_SET:
+            pos = offset
+
+        elif whence == os.SEEK_CUR:
+            pos = self._pos + offset
+
+        elif whence == os.SEEK_END:
+            pos = await self.size() + offset
+
+        else:
+            raise OSError("Not supported whence")
+
+        if pos < 0:
+            raise ValueError("offset can't be negative")
+
+        self._pos = pos
+        return self._pos
+
+    def tell(self) -> int:
+        return self._pos
+
+    async def size(self) -> int:
+        """Size of the image, waits for the seek index of CPIO images"""
+        return await self._run(lambda: self._image.size)
+
+    async def verify(self, publickey: bytes) -> None:
+        await self._run(self._image.verify, publickey)
+
+    async def close(self) -> None:
+        await self._run(self._image.close)
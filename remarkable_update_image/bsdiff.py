@@ -0,0 +1,104 @@
+import bz2
+import struct
+from collections.abc import Iterator
+from typing import cast
+
+MAGIC = b"BSDIFF40"
+
+_HEADER = struct.Struct("<8sQQQ")
+_CONTROL = struct.Struct("<QQQ")
+_SIGN = 1 << 63
+
+
+def _offtin(value: int) -> int:
+    """Decode a bsdiff offset, stored as sign and magnitude"""
+    if value & _SIGN:
+        return -(value & (_SIGN - 1))
+
+    return value
+
+
+def _add(a: bytes | memoryview, b: bytes | memoryview) -> bytes:
+    """Add a and b bytewise modulo 256"""
+    # As one big integer, so the work stays in C: the low seven bits of each
+    # byte cannot carry into the next byte, the top bit is the xor of both
+    low = int.from_bytes(b"\x7f" * len(a), "little")
+    x = int.from_bytes(a, "little")
+    y = int.from_bytes(b, "little")
+    return (((x & low) + (y & low)) ^ ((x ^ y) & ~low)).to_bytes(len(a), "little")
+
+
+def _decompress(data: bytes | memoryview) -> bytes:
+    try:
+        return bz2.decompress(data)
+
+    except (OSError, ValueError) as e:
+        raise ValueError(f"Corrupt patch: {e}") from e
+
+
+def patch(old: bytes | memoryview, data: bytes | memoryview) -> bytes:
+    """Apply the BSDIFF40 patch in data to old, ValueError if it is corrupt"""
+    if len(data) < _HEADER.size:
+        raise ValueError("Corrupt patch: too short")
+
+    magic, control_size, diff_size, new_size = cast(
+        tuple[bytes, int, int, int], _HEADER.unpack_from(data)
+    )
+    control_size = _offtin(control_size)
+    diff_size = _offtin(diff_size)
+    new_size = _offtin(new_size)
+    if magic != MAGIC:
+        raise ValueError(f"Not a bsdiff patch: {magic!r}")
+
+    if control_size < 0 or diff_size < 0 or new_size < 0:
+        raise ValueError("Corrupt patch: negative size")
+
+    view = memoryview(data)[_HEADER.size :]
+    control = _decompress(view[:control_size])
+    diff = _decompress(view[control_size : control_size + diff_size])
+    extra = _decompress(view[control_size + diff_size :])
+    if len(control) % _CONTROL.size:
+        raise ValueError("Corrupt patch: truncated control block")
+
+    new = bytearray(new_size)
+    new_pos = 0
+    old_pos = 0
+    diff_pos = 0
+    extra_pos = 0
+    for values in cast(Iterator[tuple[int, int, int]], _CONTROL.iter_unpack(control)):
+        if new_pos >= new_size:
+            break
+
+        add_size, copy_size, seek = (_offtin(x) for x in values)
+        if (
+            add_size < 0
+            or copy_size < 0
+            or new_pos + add_size + copy_size > new_size
+            or diff_pos + add_size > len(diff)
+            or extra_pos + copy_size > len(extra)
+        ):
+            raise ValueError("Corrupt patch: control out of range")
+
+        # Diff bytes are added to old, where old has data at that position
+        new[new_pos : new_pos + add_size] = diff[diff_pos : diff_pos + add_size]
+        start = max(old_pos, 0)
+        stop = min(old_pos + add_size, len(old))
+        if start < stop:
+            offset = start - old_pos
+            new[new_pos + offset : new_pos + offset + stop - start] = _add(
+                diff[diff_pos + offset : diff_pos + offset + stop - start],
+                old[start:stop],
+            )
+
+        new_pos += add_size
+        old_pos += add_size
+        diff_pos += add_size
+        new[new_pos : new_pos + copy_size] = extra[extra_pos : extra_pos + copy_size]
+        new_pos += copy_size
+        extra_pos += copy_size
+        old_pos += seek
+
+    if new_pos != new_size:
+        raise ValueError("Corrupt patch: truncated control block")
+
+    return bytes(new)
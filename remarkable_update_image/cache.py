@@ -0,0 +1,320 @@
+import contextlib
+import os
+import string
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+from collections.abc import Callable, Iterator, MutableMapping
+
+from ._compat import override
+
+_KEY_CHARS = frozenset(string.ascii_letters + string.digits + "-")
+
+POLICIES = ("lru", "ttl", "2q")
+
+
+def sizeof_fmt(num: float, suffix: str = "B") -> str:
+    for unit in ("", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"):
+        if abs(num) < 1024.0:
+            return f"{num:3.1f}{unit}{suffix}"
+        num /= 1024.0
+
+    return f"{num:.1f}Yi{suffix}"
+
+
+class BlockCache(MutableMapping[int, bytes]):
+    """In memory cache of blocks evicted by a ttl, lru or 2q policy"""
+
+    def __init__(
+        self,
+        maxsize: int,
+        ttl: float = 60,
+        timer: Callable[[], float] = time.monotonic,
+        getsizeof: Callable[[bytes], int] = len,
+        policy: str = "ttl",
+        *,
+        on_evict: Callable[[int, bytes], None] | None = None,
+    ) -> None:
+        if policy not in POLICIES:
+            raise ValueError(f"Unknown cache policy: {policy}")
+
+        self.maxsize: int = maxsize
+        self.ttl: float = ttl
+        self.timer: Callable[[], float] = timer
+        self.getsizeof: Callable[[bytes], int] = getsizeof
+        self.policy: str = policy
+        self.on_evict: Callable[[int, bytes], None] | None = on_evict
+        self.currsize: int = 0
+        self._data: dict[int, bytes] = {}
+        self._sizes: dict[int, int] = {}
+        # Main LRU queue, the only queue used by the lru and ttl policies
+        self._main: OrderedDict[int, None] = OrderedDict()
+        # 2q probation FIFO, the bytes it holds, and recently evicted keys
+        self._probation: OrderedDict[int, None] = OrderedDict()
+        self._probation_size: int = 0
+        self._ghosts: OrderedDict[int, None] = OrderedDict()
+        self._expires: OrderedDict[int, float] = OrderedDict()
+
+    @property
+    def usage_str(self) -> str:
+        return f"{self.curr_size_str}/{self.max_size_str}"
+
+    @property
+    def curr_size_str(self) -> str:
+        return sizeof_fmt(self.currsize)
+
+    @property
+    def max_size_str(self) -> str:
+        return sizeof_fmt(self.maxsize)
+
+    def will_fit(self, value: bytes) -> bool:
+        return self.maxsize >= self.getsizeof(value)
+
+    def _expired(self, key: int, now: float) -> bool:
+        return self.policy == "ttl" and self._expires[key] <= now
+
+    @override
+    def __contains__(self, key: object) -> bool:
+        return key in self._data and not self._expired(key, self.timer())  # pyright: ignore[reportArgumentType]
+
+    @override
+    def __getitem__(self, key: int) -> bytes:
+        value = self._data[key]
+        if self._expired(key, self.timer()):
+            del self[key]
+            raise KeyError(key)
+
+        if key in self._main:
+            self._main.move_to_end(key)
+
+        return value
+
+    @override
+    def __setitem__(self, key: int, value: bytes) -> None:
+        size = self.getsizeof(value)
+        if size > self.maxsize:
+            raise ValueError("value too large")
+
+        if key in self._data:
+            del self[key]
+
+        _ = self.expire()
+        self._data[key] = value
+        self._sizes[key] = size
+        self._expires[key] = self.timer() + self.ttl
+        self.currsize += size
+        if self.policy != "2q" or key in self._ghosts:
+            _ = self._ghosts.pop(key, None)
+            self._main[key] = None
+
+        else:
+            self._probation[key] = None
+            self._probation_size += size
+
+        while self.currsize > self.maxsize:
+            self._evict()
+
+    @override
+    def __delitem__(self, key: int) -> None:
+        del self._data[key]
+        size = self._sizes.pop(key)
+        self.currsize -= size
+        del self._expires[key]
+        if key in self._probation:
+            del self._probation[key]
+            self._probation_size -= size
+
+        else:
+            del self._main[key]
+
+    @override
+    def __iter__(self) -> Iterator[int]:
+        return iter(list(self._data))
+
+    @override
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def _evict(self) -> None:
+        if self._probation and (
+            not self._main or self._probation_size > self.maxsize // 4
+        ):
+            key = next(iter(self._probation))
+            self._evicted(key)
+            self._ghosts[key] = None
+            while len(self._ghosts) > max(len(self._data), 1024):
+                _ = self._ghosts.popitem(last=False)
+
+            return
+
+        key = next(iter(self._main))
+        self._evicted(key)
+
+    def _evicted(self, key: int) -> None:
+        value = self._data[key]
+        del self[key]
+        if self.on_evict is not None:
+            self.on_evict(key, value)
+
+    def expire(self, time: float | None = None) -> list[tuple[int, bytes]]:
+        """Remove expired entries, returns the removed items"""
+        if self.policy != "ttl":
+            return []
+
+        if time is None:
+            time = self.timer()
+
+        expired: list[tuple[int, bytes]] = []
+        while self._expires:
+            key, expires = next(iter(self._expires.items()))
+            if expires > time:
+                break
+
+            expired.append((key, self._data[key]))
+            self._evicted(key)
+
+        return expired
+
+    @override
+    def clear(self) -> None:
+        self._data.clear()
+        self._sizes.clear()
+        self._main.clear()
+        self._probation.clear()
+        self._probation_size = 0
+        self._ghosts.clear()
+        self._expires.clear()
+        self.currsize = 0
+
+
+class DiskCache:
+    """Size capped, content addressed cache of blobs shared between processes"""
+
+    def __init__(self, path: str, maxsize: int) -> None:
+        self.path: str = path
+        self.maxsize: int = maxsize
+        self._lock: threading.Lock = threading.Lock()
+        self._currsize: int | None = None
+        os.makedirs(self.path, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        if not key or any(x not in _KEY_CHARS for x in key):
+            raise KeyError(key)
+
+        return os.path.join(self.path, key[:2], key)
+
+    def get(self, key: str) -> bytes | None:
+        path = self._path(key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+
+        except FileNotFoundError:
+            return None
+
+        with contextlib.suppress(OSError):
+            os.utime(path)
+
+        return data
+
+    def set(self, key: str, value: bytes, *, replace: bool = False) -> None:
+        """Store value under key, existing entries are kept unless replace"""
+        if len(value) > self.maxsize:
+            return
+
+        path = self._path(key)
+        replaced = 0
+        if os.path.exists(path):
+            if not replace:
+                return
+
+            with contextlib.suppress(OSError):
+                replaced = os.path.getsize(path)
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                _ = f.write(value)
+
+            os.replace(tmp, path)
+
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.unlink(tmp)
+
+            raise
+
+        with self._lock:
+            if self._currsize is not None:
+                self._currsize += len(value) - replaced
+
+            if self._currsize is None or self._currsize > self.maxsize:
+                self._evict()
+
+    def delete(self, key: str) -> None:
+        path = self._path(key)
+        try:
+            size = os.path.getsize(path)
+            os.unlink(path)
+
+        except FileNotFoundError:
+            return
+
+        with self._lock:
+            if self._currsize is not None:
+                self._currsize -= size
+
+    def _entries(self) -> list[os.DirEntry[str]]:
+        entries: list[os.DirEntry[str]] = []
+        for subdir in os.scandir(self.path):
+            if not subdir.is_dir():
+                continue
+
+            entries.extend(
+                x for x in os.scandir(subdir.path) if not x.name.startswith(".")
+            )
+
+        return entries
+
+    def _evict(self) -> None:
+        entries: list[tuple[float, int, str]] = []
+        for entry in self._entries():
+            try:
+                stat = entry.stat()
+
+            except FileNotFoundError:
+                continue
+
+            entries.append((stat.st_mtime, stat.st_size, entry.path))
+
+        currsize = sum(x[1] for x in entries)
+        if currsize > self.maxsize:
+            # Free a little more than needed so every insert does not rescan
+            target = self.maxsize * 9 // 10
+            for _, size, path in sorted(entries):
+                if currsize <= target:
+                    break
+
+                try:
+                    os.unlink(path)
+
+                except FileNotFoundError:
+                    pass
+
+                except OSError:
+                    continue
+
+                currsize -= size
+
+        self._currsize = currsize
+
+    @property
+    def currsize(self) -> int:
+        with self._lock:
+            if self._currsize is None:
+                self._evict()
+
+            assert self._currsize is not None
+            return self._currsize
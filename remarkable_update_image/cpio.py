@@ -1,6 +1,7 @@
 import errno
 import io
 from collections.abc import (
+    Generator,
     KeysView,
     ValuesView,
 )
@@ -12,10 +13,12 @@ from ctypes import (
     c_ushort,
     sizeof,
 )
-from struct import pack
-from typing import final
+from functools import cached_property
+from struct import Struct
+from struct import error as struct_error
+from typing import cast, final
 
-from ._compat import FileObj
+from ._compat import FileObj, StreamObj
 
 
 class MagicError(Exception):
@@ -232,58 +235,121 @@ cpio_newc_header_le.size = property(_cpio_newc_header_size)  # pyright: ignore[r
 cpio_newc_header_be.size = property(_cpio_newc_header_size)  # pyright: ignore[reportAttributeAccessIssue]
 
 
-class Entry:
-    def __init__(self, fileobj: FileObj, offset: int) -> None:
-        self.fileobj: FileObj = fileobj
-        self.offset: int = offset
-        self.cursor: int = 0
-        self.header: Structure = self.read_header()
-        self.header.verify()  # pyright: ignore[reportAny]
-        self.dataoffset: int = offset + self.header.size  # pyright: ignore[reportAny]
+# Fixed size headers as read by struct, the name follows each header
+_OLD_LE = Struct("<13H")
+_OLD_BE = Struct(">13H")
+_ODC = Struct("6s6s6s6s6s6s6s6s11s6s11s")
+_NEWC = Struct("6s8s8s8s8s8s8s8s8s8s8s8s8s8s")
+# Enough bytes to hold any of the fixed size headers
+HEADER_SIZE = _NEWC.size
+# Amount read at once while scanning the headers of an archive
+SCAN_SIZE = 64 * 1024
+
+
+def _pad(size: int, align: int) -> int:
+    return size + (-size % align)
+
+
+def parse_header(
+    data: bytes | memoryview,
+) -> tuple[type[Structure], int, int, int, int]:
+    """Return the type, name size, file size, header and entry size of data"""
+    magic = data[:2]
+    if magic in (b"\xc7\x71", b"\x71\xc7"):
+        le = magic == b"\xc7\x71"
+        fields = cast(tuple[int, ...], (_OLD_LE if le else _OLD_BE).unpack_from(data))
+        namesize = fields[10]
+        filesize = (fields[11] << 16) | fields[12]
+        size = _pad(_OLD_LE.size + namesize, 2)
+        return (
+            header_old_cpio_le if le else header_old_cpio_be,
+            namesize,
+            filesize,
+            size,
+            size + _pad(filesize, 2),
+        )
 
-    def __len__(self) -> int:
-        return self.header.filesize  # pyright: ignore[reportAny]
+    magic = data[:6]
+    if magic == b"070707":
+        raw = cast(tuple[bytes, ...], _ODC.unpack_from(data))
+        namesize = int(raw[9], 8)
+        filesize = int(raw[10], 8)
+        size = _ODC.size + namesize + namesize % 2
+        return cpio_odc_header_le, namesize, filesize, size, size + _pad(filesize, 2)
 
-    def read_header(self) -> Structure:
-        _ = self.fileobj.seek(self.offset)
-        magic = self.fileobj.read(sizeof(c_ushort))
-        if magic == pack(">H", 0o070707):
-            cls = header_old_cpio_be
+    if magic in (b"070701", b"070702"):
+        raw = cast(tuple[bytes, ...], _NEWC.unpack_from(data))
+        namesize = int(raw[12], 16)
+        filesize = int(raw[7], 16)
+        size = _pad(_NEWC.size + namesize, 4)
+        return cpio_newc_header_le, namesize, filesize, size, size + _pad(filesize, 4)
 
-        elif magic == pack("<H", 0o070707):
-            cls = header_old_cpio_le
+    raise MagicError(f"Unknown magic: {bytes(magic)}")
 
-        else:
-            _ = self.fileobj.seek(self.offset)
-            magic = self.fileobj.read(sizeof(c_char * 6))
-            if magic == b"070707":
-                cls = cpio_odc_header_le
 
-            # elif magic == b"070707":
-            #     cls = cpio_odc_header_be
-
-            elif magic in (b"070701", b"070702"):
-                cls = cpio_newc_header_le
+class Entry:
+    def __init__(
+        self,
+        fileobj: FileObj,
+        offset: int,
+        header: bytes | memoryview | None = None,
+    ) -> None:
+        self.fileobj: FileObj = fileobj
+        self.offset: int = offset
+        self.cursor: int = 0
+        self.bytes_read: int = 0
+        # header is the data at offset when the caller has already read it
+        if header is None:
+            _ = self.fileobj.seek(self.offset)
+            header = self.fileobj.read(HEADER_SIZE)
+
+        try:
+            header_type, namesize, filesize, headersize, entrysize = parse_header(
+                header
+            )
+
+        except struct_error as e:
+            raise OSError(errno.EIO, "Unexpected EOF") from e
+
+        self._header_type: type[Structure] = header_type
+        self.namesize: int = namesize
+        self.filesize: int = filesize
+        self.headersize: int = headersize
+        self.entrysize: int = entrysize
+
+        name_offset = sizeof(header_type)
+        self._header: bytes = bytes(header[:name_offset])
+        self._name: bytes | None = None
+        if len(header) >= name_offset + namesize:
+            self._name = bytes(header[name_offset : name_offset + namesize]).rstrip(
+                b"\x00"
+            )
+        self.dataoffset: int = offset + self.headersize
 
-            # elif magic in (b"070701", b"070702"):
-            #     cls = cpio_newc_header_be
+    def __len__(self) -> int:
+        return self.filesize
 
-            else:
-                raise MagicError(f"Unknown magic: {magic}")
+    @cached_property
+    def header(self) -> Structure:
+        header = self._header_type.from_buffer_copy(self._header)
+        header.verify()  # pyright: ignore[reportAny]
+        return header
 
-        _ = self.fileobj.seek(self.offset)
-        data = self.fileobj.read(sizeof(cls))
-        return cls.from_buffer_copy(data)
+    def read_header(self) -> Structure:
+        return self.header
 
     @property
     def name(self) -> bytes:
-        _ = self.fileobj.seek(self.offset + sizeof(self.header))
-        return self.fileobj.read(self.header.namesize).rstrip(b"\x00")  # pyright: ignore[reportAny]
+        if self._name is None:
+            _ = self.fileobj.seek(self.offset + sizeof(self._header_type))
+            self._name = self.fileobj.read(self.namesize).rstrip(b"\x00")
+
+        return self._name
 
     @property
     def data(self) -> bytes:
         _ = self.fileobj.seek(self.dataoffset)
-        return self.fileobj.read(self.header.filesize)  # pyright: ignore[reportAny]
+        return self.fileobj.read(self.filesize)
 
     @property
     def size(self) -> int:
@@ -335,7 +401,9 @@ class Entry:
             size = len(self) - self.cursor
 
         _ = self.fileobj.seek(self.dataoffset + self.cursor)
-        return self.fileobj.read(size)
+        data = self.fileobj.read(size)
+        self.bytes_read += len(data)
+        return data
 
 
 class Archive:
@@ -357,6 +425,7 @@ class Archive:
         return len(self.entries)
 
     def open(self) -> None:
+        """Scan the entry headers in a single pass over SCAN_SIZE buffers"""
         if self.fileobj is not None:
             return
 
@@ -366,17 +435,33 @@ class Archive:
         else:
             self.fileobj = self.fileOrPath
 
+        buffer = memoryview(b"")
+        start = 0
         offset = 0
-        _ = self.fileobj.seek(0, io.SEEK_END)
-        size = self.fileobj.tell()
-        _ = self.fileobj.seek(0, io.SEEK_SET)
-        while offset < size:
-            entry = Entry(self.fileobj, offset)
+        while True:
+            pos = offset - start
+            if pos + HEADER_SIZE > len(buffer):
+                _ = self.fileobj.seek(offset)
+                buffer = memoryview(self.fileobj.read(SCAN_SIZE))
+                start = offset
+                pos = 0
+
+            if pos >= len(buffer):
+                break
+
+            entry = Entry(self.fileobj, offset, buffer[pos:])
+            if pos + entry.headersize > len(buffer):
+                # The name runs past the end of the buffer
+                _ = self.fileobj.seek(offset)
+                buffer = memoryview(self.fileobj.read(max(SCAN_SIZE, entry.headersize)))
+                start = offset
+                entry = Entry(self.fileobj, offset, buffer)
+
             if entry.name == b"TRAILER!!!":
                 break
 
             self.entries[entry.name] = entry
-            offset += entry.header.entrysize  # pyright: ignore[reportAny]
+            offset += entry.entrysize
 
     def close(self) -> None:
         if isinstance(self.fileOrPath, str):
@@ -397,3 +482,107 @@ class Archive:
 
     def values(self) -> ValuesView[Entry]:
         return self.entries.values()
+
+
+def _read_exact(stream: StreamObj, size: int) -> bytes:
+    data = stream.read(size)
+    while len(data) < size:
+        chunk = stream.read(size - len(data))
+        if not chunk:
+            raise OSError(errno.EIO, "Unexpected EOF")
+
+        data += chunk
+
+    return data
+
+
+class StreamEntry:
+    """Entry of a stream, readable forward until the next entry is requested"""
+
+    def __init__(
+        self,
+        stream: StreamObj,
+        header_type: type[Structure],
+        header: bytes,
+        name: bytes,
+        filesize: int,
+    ) -> None:
+        self.stream: StreamObj = stream
+        self._header_type: type[Structure] = header_type
+        self._header: bytes = header
+        self.name: bytes = name
+        self.filesize: int = filesize
+        self.cursor: int = 0
+
+    def __len__(self) -> int:
+        return self.filesize
+
+    @cached_property
+    def header(self) -> Structure:
+        header = self._header_type.from_buffer_copy(self._header)
+        header.verify()  # pyright: ignore[reportAny]
+        return header
+
+    @property
+    def size(self) -> int:
+        return len(self)
+
+    def writable(self) -> bool:
+        return False
+
+    def seekable(self) -> bool:
+        return False
+
+    def readable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.cursor
+
+    def read(self, size: int = -1) -> bytes:
+        remaining = len(self) - self.cursor
+        if size < 0 or size > remaining:
+            size = remaining
+
+        data = _read_exact(self.stream, size)
+        self.cursor += size
+        return data
+
+    def skip(self) -> None:
+        """Discard the rest of the data"""
+        while self.cursor < len(self):
+            _ = self.read(min(len(self) - self.cursor, SCAN_SIZE))
+
+
+def iter_entries(stream: StreamObj) -> Generator[StreamEntry]:
+    """Iterate over the entries of a readable stream in a single forward pass"""
+    while True:
+        header = stream.read(2)
+        if not header:
+            return
+
+        header = header + _read_exact(stream, 2 - len(header))
+        if header in (b"\xc7\x71", b"\x71\xc7"):
+            header += _read_exact(stream, _OLD_LE.size - len(header))
+
+        else:
+            header += _read_exact(stream, 4)
+            size = _ODC.size if header == b"070707" else _NEWC.size
+            header += _read_exact(stream, size - len(header))
+
+        try:
+            header_type, namesize, filesize, headersize, entrysize = parse_header(
+                header
+            )
+
+        except struct_error as e:
+            raise OSError(errno.EIO, "Unexpected EOF") from e
+
+        name = _read_exact(stream, headersize - len(header))[:namesize].rstrip(b"\x00")
+        if name == b"TRAILER!!!":
+            return
+
+        entry = StreamEntry(stream, header_type, header, name, filesize)
+        yield entry
+        entry.skip()
+        _ = _read_exact(stream, entrysize - headersize - filesize)
@@ -1,10 +1,16 @@
 import bz2
+import contextlib
+import functools
 import io
+import mmap
 import os
 import struct
-import sys
+import threading
 import time
-from collections.abc import Callable, Generator
+from array import array
+from bisect import bisect_left, bisect_right
+from collections.abc import Callable, Generator, Iterable
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
 from hashlib import sha256
 from typing import (
     Any,
@@ -12,7 +18,7 @@ from typing import (
 )
 
 import libconf
-from cachetools import TTLCache
+from cryptography.exceptions import InvalidSignature
 from cryptography.hazmat.primitives.asymmetric.padding import PKCS1v15
 from cryptography.hazmat.primitives.hashes import SHA256
 from cryptography.hazmat.primitives.serialization import load_pem_public_key
@@ -20,103 +26,590 @@ from indexed_gzip import (
     IndexedGzipFile as GzipFile,  # pyright: ignore[reportUnknownVariableType]
 )
 
-from ._compat import override
+from . import bsdiff
+from ._compat import Buffer, open_fd, override, pread, pwrite
+from .cache import (
+    BlockCache,
+    DiskCache,
+)
+
+# Re-exported, sizeof_fmt used to live here
+from .cache import sizeof_fmt as sizeof_fmt  # noqa: PLC0414
 from .cpio import (
     Archive,
     Entry,
 )
+from .stats import Hook, Stats, timer
 from .update_metadata_pb2 import (
     DeltaArchiveManifest,  # pyright: ignore[reportAttributeAccessIssue, reportUnknownVariableType]
     InstallOperation,  # pyright: ignore[reportAttributeAccessIssue, reportUnknownVariableType]
     Signatures,  # pyright: ignore[reportAttributeAccessIssue, reportUnknownVariableType]
 )
 
+CHUNK_SIZE = 1024 * 1024
+INDEX_STEP = 4 * 1024 * 1024
+PAGE_SIZE = 64 * 1024
+PEEK_SIZE = 4 * 1024 * 1024
+# Consecutive sequential reads needed before readahead starts
+SEQUENTIAL_READS = 2
+
+# Start block of a dst extent that is a sparse hole, its data is skipped
+SPARSE_HOLE = 0xFFFFFFFFFFFFFFFF
+# Operation types that are applied to the data of a base image
+DELTA_TYPES = (2, 3)
 
-def sizeof_fmt(num: float, suffix: str = "B") -> str:
-    for unit in ("", "Ki", "Mi", "Gi", "Ti", "Pi", "Ei", "Zi"):
-        if abs(num) < 1024.0:
-            return f"{num:3.1f}{unit}{suffix}"
-        num /= 1024.0
+# dst extents as (offset, length), data offset, data length, type, sha256
+BlobRow = tuple[tuple[tuple[int, int], ...], int, int, int, bytes]
 
-    return f"{num:.1f}Yi{suffix}"
+_ZEROS = bytes(CHUNK_SIZE)
 
 
 def range_contains(range1: range, range2: range) -> bool:
     return range1.start < range2.stop and range2.start < range1.stop
 
 
-class BlockCache(TTLCache[tuple[int, int] | int, bytes]):
+class UpdateImageException(Exception):
+    pass
+
+
+class UpdateImageSignatureException(UpdateImageException):
+    def __init__(self, message: str, signed_hash: bytes, actual_hash: bytes) -> None:
+        super().__init__(message)
+        self.signed_hash: bytes = signed_hash
+        self.actual_hash: bytes = actual_hash
+
+
+def _check_hash(
+    blob_data: bytes | memoryview,
+    expected_hash: bytes,
+    *,
+    stats: Stats | None = None,
+    index: int | None = None,
+) -> None:
+    with timer(stats, "sha256", index):
+        actual_hash = sha256(blob_data).digest()
+
+    if actual_hash != expected_hash:
+        raise UpdateImageException("Error: Data has wrong sha256sum")
+
+
+def _decode_blob(
+    blob_data: bytes,
+    blob_type: int,
+    blob_length: int,
+    expected_hash: bytes,
+    *,
+    stats: Stats | None = None,
+    index: int | None = None,
+    verified: bool = False,
+) -> bytes:
+    if blob_type not in (
+        InstallOperation.Type.REPLACE,  # pyright: ignore[reportUnknownMemberType]
+        InstallOperation.Type.REPLACE_BZ,  # pyright: ignore[reportUnknownMemberType]
+    ):
+        raise NotImplementedError(
+            f"Error: {InstallOperation.Type.keys()[blob_type]} has not been implemented yet"  # pyright: ignore[reportUnknownMemberType]
+        )
+
+    if not verified:
+        _check_hash(blob_data, expected_hash, stats=stats, index=index)
+
+    if blob_type == InstallOperation.Type.REPLACE_BZ:  # pyright: ignore[reportUnknownMemberType]
+        try:
+            with timer(stats, "bz2", index):
+                blob_data = bz2.decompress(blob_data)
+
+        except ValueError as err:
+            raise UpdateImageException(f"Error: {err}") from err
+
+        if stats is not None:
+            stats.add("bytes_decompressed", len(blob_data), index)
+
+        if blob_length - len(blob_data) < 0:
+            raise UpdateImageException(
+                f"Error: Bz2 compressed data was too large {len(blob_data)}"
+            )
+
+    return blob_data
+
+
+def _cache_get(
+    cache: DiskCache, key: str, stats: Stats, *, index: int | None = None
+) -> bytes | None:
+    """Read key from the disk cache, errors are counted and treated as a miss"""
+    try:
+        return cache.get(key)
+
+    except OSError:
+        stats.add("disk_cache_errors", blob=index)
+        return None
+
+
+def _cache_set(
+    cache: DiskCache,
+    key: str,
+    value: bytes,
+    stats: Stats,
+    *,
+    index: int | None = None,
+    replace: bool = False,
+) -> None:
+    """Store key in the disk cache, errors are counted and otherwise ignored"""
+    try:
+        cache.set(key, value, replace=replace)
+
+    except OSError:
+        stats.add("disk_cache_errors", blob=index)
+
+
+def _zero_fill(buffer: memoryview) -> None:
+    """Zero buffer in place without allocating"""
+    zeros = memoryview(_ZEROS)
+    for pos in range(0, len(buffer), len(zeros)):
+        chunk = buffer[pos : pos + len(zeros)]
+        chunk[:] = zeros[: len(chunk)]
+
+
+def _create_output(path: str, size: int) -> None:
+    """Create or truncate path to size bytes, leaving it as one hole"""
+    fd = os.open(
+        path,
+        os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0),
+        0o644,
+    )
+    try:
+        os.ftruncate(fd, size)
+
+    finally:
+        os.close(fd)
+
+
+def _write_data(
+    fd: int, data: bytes | memoryview, offset: int, sparse: bool, block_size: int
+) -> int:
+    """pwrite data at offset, skipping all-zero blocks when sparse"""
+    if not sparse:
+        pwrite(fd, data, offset)
+        return len(data)
+
+    view = memoryview(data)
+    zero = bytes(block_size)
+    written = 0
+    start = -1
+    for pos in range(0, len(view), block_size):
+        if zero.startswith(view[pos : pos + block_size]):
+            if start >= 0:
+                pwrite(fd, view[start:pos], offset + start)
+                written += pos - start
+                start = -1
+
+        elif start < 0:
+            start = pos
+
+    if start >= 0:
+        pwrite(fd, view[start:], offset + start)
+        written += len(view) - start
+
+    return written
+
+
+def _write_extents(
+    fd: int,
+    data: bytes | memoryview,
+    extents: Iterable[tuple[int, int]],
+    sparse: bool,
+    block_size: int,
+) -> int:
+    """Lay data out over the (offset, length) extents of a blob in fd"""
+    view = memoryview(data)
+    written = 0
+    blob_offset = 0
+    for dst_offset, length in extents:
+        if dst_offset != SPARSE_HOLE:
+            written += _write_data(
+                fd,
+                view[blob_offset : blob_offset + length],
+                dst_offset,
+                sparse,
+                block_size,
+            )
+
+        blob_offset += length
+
+    return written
+
+
+def _extract_blobs(
+    update_file: str,
+    offset: int,
+    path: str,
+    rows: list[BlobRow],
+    *,
+    sparse: bool = False,
+    block_size: int = 4096,
+) -> int:
+    """Decode rows of a BlobTable and write them to path, returns bytes written"""
+    written = 0
+    src = open_fd(update_file)
+    try:
+        dst = os.open(path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+        try:
+            for extents, data_offset, data_length, type_, hash_ in rows:
+                data = _decode_blob(
+                    pread(src, data_length, offset + data_offset),
+                    type_,
+                    sum(x[1] for x in extents),
+                    hash_,
+                )
+                written += _write_extents(dst, data, extents, sparse, block_size)
+
+        finally:
+            os.close(dst)
+
+    finally:
+        os.close(src)
+
+    return written
+
+
+class BlobTable:
+    """Array backed index of the blobs in a payload manifest and their extents"""
+
     def __init__(
         self,
-        maxsize: int,
-        ttl: int,
-        timer: Callable[[], float] = time.monotonic,
-        getsizeof: Callable[[object], int] = sys.getsizeof,
+        operations: Iterable[InstallOperation],  # pyright: ignore[reportUnknownParameterType]
+        block_size: int,
     ) -> None:
-        super().__init__(maxsize, ttl, timer, getsizeof)
+        self.lengths: array[int] = array("Q")
+        self.data_offsets: array[int] = array("Q")
+        self.data_lengths: array[int] = array("Q")
+        self.types: array[int] = array("B")
+        self.hashes: list[bytes] = []
+        # Extents of blob i are first_extents[i] up to first_extents[i + 1]
+        self.first_extents: array[int] = array("Q", [0])
+        self.extent_offsets: array[int] = array("Q")
+        self.extent_lengths: array[int] = array("Q")
+        self.extent_blobs: array[int] = array("Q")
+        self.extent_blob_offsets: array[int] = array("Q")
+        # Src extents of blob i are first_sources[i] up to first_sources[i + 1]
+        self.first_sources: array[int] = array("Q", [0])
+        self.source_offsets: array[int] = array("Q")
+        self.source_lengths: array[int] = array("Q")
+        # Bytes of the src extents that are used, as given by src_length
+        self.source_sizes: array[int] = array("Q")
+        for blob in operations:  # pyright: ignore[reportUnknownVariableType]
+            if blob.type not in (0, 1, *DELTA_TYPES):  # pyright: ignore[reportUnknownMemberType]
+                raise UpdateImageException(f"Unsupported type {blob.type}")  # pyright: ignore[reportUnknownMemberType]
+
+            source_size = 0
+            for extent in blob.src_extents:  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
+                start_block = cast(int, extent.start_block)
+                length = cast(int, extent.num_blocks * block_size)
+                self.source_offsets.append(
+                    start_block
+                    if start_block == SPARSE_HOLE
+                    else start_block * block_size
+                )
+                self.source_lengths.append(length)
+                source_size += length
+
+            self.first_sources.append(len(self.source_offsets))
+            if blob.HasField("src_length"):  # pyright: ignore[reportUnknownMemberType]
+                source_size = min(source_size, cast(int, blob.src_length))
+
+            self.source_sizes.append(source_size)
+
+            blob_offset = 0
+            for extent in blob.dst_extents:  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
+                start_block = cast(int, extent.start_block)
+                length = cast(int, extent.num_blocks * block_size)
+                self.extent_offsets.append(
+                    start_block
+                    if start_block == SPARSE_HOLE
+                    else start_block * block_size
+                )
+                self.extent_lengths.append(length)
+                self.extent_blobs.append(len(self.lengths))
+                self.extent_blob_offsets.append(blob_offset)
+                blob_offset += length
+
+            self.first_extents.append(len(self.extent_offsets))
+            self.lengths.append(blob_offset)
+            self.data_offsets.append(cast(int, blob.data_offset))
+            self.data_lengths.append(cast(int, blob.data_length))
+            self.types.append(cast(int, blob.type))
+            self.hashes.append(cast(bytes, blob.data_sha256_hash))
+
+        mapped = sorted(
+            (
+                x
+                for x in range(len(self.extent_offsets))
+                if self.extent_offsets[x] != SPARSE_HOLE
+            ),
+            key=self.extent_offsets.__getitem__,
+        )
+        # Mapped extents sorted by image offset, and their offsets for bisect
+        self.order: array[int] = array("Q", mapped)
+        self.starts: array[int] = array("Q", (self.extent_offsets[x] for x in mapped))
+        self._size: int = max(
+            (self.extent_offsets[x] + self.extent_lengths[x] for x in mapped),
+            default=0,
+        )
+
+    def __len__(self) -> int:
+        return len(self.lengths)
 
     @property
-    def usage_str(self) -> str:
-        return f"{self.curr_size_str}/{self.max_size_str}"
+    def size(self) -> int:
+        """End of the last mapped extent, gaps before it read as zeros"""
+        return self._size
+
+    def extents(self, index: int) -> range:
+        """Return the indexes of the extents of blob index"""
+        return range(self.first_extents[index], self.first_extents[index + 1])
+
+    def sources(self, index: int) -> list[tuple[int, int]]:
+        """Return the src extents of blob index as (offset, length)"""
+        return [
+            (self.source_offsets[x], self.source_lengths[x])
+            for x in range(self.first_sources[index], self.first_sources[index + 1])
+        ]
+
+    def is_delta(self, index: int) -> bool:
+        return self.types[index] in DELTA_TYPES
+
+    def overlapping(self, start: int, stop: int) -> list[int]:
+        """Return the mapped extents that overlap [start, stop) in image order"""
+        if start >= stop:
+            return []
+
+        first = max(bisect_right(self.starts, start) - 1, 0)
+        if (
+            first < len(self.starts)
+            and self.starts[first] + self.extent_lengths[self.order[first]] <= start
+        ):
+            first += 1
+
+        return list(self.order[first : bisect_left(self.starts, stop)])
+
+    def following(self, offset: int, count: int) -> list[int]:
+        """Return up to count blobs mapped at or after offset in image order"""
+        blobs: list[int] = []
+        for pos in range(bisect_left(self.starts, offset), len(self.starts)):
+            index = self.extent_blobs[self.order[pos]]
+            if index not in blobs:
+                blobs.append(index)
+                if len(blobs) >= count:
+                    break
+
+        return blobs
+
+    def row(self, index: int) -> BlobRow:
+        return (
+            tuple(
+                (self.extent_offsets[x], self.extent_lengths[x])
+                for x in self.extents(index)
+            ),
+            self.data_offsets[index],
+            self.data_lengths[index],
+            self.types[index],
+            self.hashes[index],
+        )
+
+    def batches(self, count: int) -> list[list[BlobRow]]:
+        """Split the rows into about count batches of similar payload size"""
+        limit = max(sum(self.data_lengths) // max(count, 1), 1)
+        batches: list[list[BlobRow]] = []
+        batch: list[BlobRow] = []
+        size = 0
+        for index in range(len(self)):
+            # Delta operations need the base image
+            if self.is_delta(index):
+                continue
+
+            batch.append(self.row(index))
+            size += self.data_lengths[index]
+            if size >= limit:
+                batches.append(batch)
+                batch = []
+                size = 0
+
+        if batch:
+            batches.append(batch)
+
+        return batches
+
+
+class MappedFile:
+    """Read only file object over a memory mapping"""
+
+    def __init__(self, data: mmap.mmap) -> None:
+        self._data: mmap.mmap = data
+
+    def read(self, size: int | None = -1, /) -> bytes:
+        return self._data.read(size)
+
+    def tell(self) -> int:
+        return self._data.tell()
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET, /) -> int:
+        _ = self._data.seek(offset, whence)  # pyright: ignore[reportArgumentType]
+        return self._data.tell()
+
+    def close(self) -> None:
+        pass
+
+
+class SequentialDetector:
+    """Detects reads that continue where the previous read stopped"""
+
+    def __init__(self, threshold: int = SEQUENTIAL_READS) -> None:
+        self.threshold: int = threshold
+        self.next: int = -1
+        self.count: int = 0
+
+    def update(self, offset: int, size: int) -> bool:
+        """Record a read, returns True once enough reads were sequential"""
+        self.count = self.count + 1 if offset == self.next else 0
+        self.next = offset + size
+        return self.count >= self.threshold
+
+
+class CachedImage(io.RawIOBase):
+    """Block cache, disk cache and stats shared by both kinds of image"""
+
+    _stats: Stats
+    _cache: BlockCache
+    _disk_cache: DiskCache | None
 
     @property
-    def curr_size_str(self) -> str:
-        return sizeof_fmt(self.currsize)
+    def cache(self) -> BlockCache:
+        return self._cache
 
     @property
-    def max_size_str(self) -> str:
-        return sizeof_fmt(self.maxsize)
+    def disk_cache(self) -> DiskCache | None:
+        return self._disk_cache
 
-    def will_fit(self, value: bytes) -> bool:
-        return self.maxsize >= self.getsizeof(value)
+    def _on_evict(self, _key: int, _value: bytes) -> None:
+        self._stats.add("cache_evictions")
 
+    def stats(self) -> dict[str, object]:
+        """Cache, I/O and timing counters so far, and the same per blob index"""
+        return self._stats.as_dict()
 
-class UpdateImageException(Exception):
-    pass
+    def reset_stats(self) -> None:
+        self._stats.reset()
 
+    def add_hook(self, hook: Hook) -> None:
+        """Call hook(name, amount, blob) whenever a stat is recorded"""
+        self._stats.hooks.append(hook)
 
-class UpdateImageSignatureException(UpdateImageException):
-    def __init__(self, message: str, signed_hash: bytes, actual_hash: bytes) -> None:
-        super().__init__(message)
-        self.signed_hash: bytes = signed_hash
-        self.actual_hash: bytes = actual_hash
+    def remove_hook(self, hook: Hook) -> None:
+        self._stats.hooks.remove(hook)
 
 
-class ProtobufUpdateImage(io.RawIOBase):
+class ProtobufUpdateImage(CachedImage):
     def __init__(
-        self, update_file: str, cache_size: int = 500, cache_ttl: int = 60
+        self,
+        update_file: str,
+        cache_size: int = 500,
+        cache_ttl: int = 60,
+        *,
+        disk_cache: str | None = None,
+        disk_cache_size: int = 2048,
+        cache_policy: str = "ttl",
+        readahead: int = 4,
+        use_mmap: bool = False,
+        base: "ProtobufUpdateImage | CPIOUpdateImage | None" = None,
     ) -> None:
         self._pos: int = 0
+        self._fd: int = -1
+        # Image that MOVE and BSDIFF operations read their src extents from
+        self._base: ProtobufUpdateImage | CPIOUpdateImage | None = base
+        self._mmap: mmap.mmap | None = None
+        self._view: memoryview | None = None
+        self._stats: Stats = Stats()
+        # Protects the cache and the blobs that are being decoded
+        self._lock: threading.Lock = threading.Lock()
+        self._pending: dict[int, Future[bytes]] = {}
+        self._executor: ThreadPoolExecutor | None = None
+        self._sequential: SequentialDetector = SequentialDetector()
+        self.readahead: int = readahead
+        # Bitmap of the blobs whose payload hash has already been checked
+        self._verified: bytearray = bytearray()
+        self._verified_changed: bool = False
+        self._ledger_key: str | None = None
         self.update_file: str = update_file
         self.cache_size: int = cache_size
         self._cache: BlockCache = BlockCache(
             maxsize=cache_size * 1024 * 1024,
             ttl=cache_ttl,
+            policy=cache_policy,
+            on_evict=self._on_evict,
         )
-        with open(self.update_file, "rb") as f:
-            magic = f.read(4)
+        self._disk_cache: DiskCache | None = None
+        if disk_cache is not None:
+            self._disk_cache = DiskCache(disk_cache, disk_cache_size * 1024 * 1024)
+        self._fd = open_fd(self.update_file)
+        try:
+            magic = pread(self._fd, 4, 0)
             if magic != b"CrAU":
                 raise UpdateImageException("Wrong header")
 
-            major = struct.unpack(">Q", f.read(8))[0]
+            if use_mmap:
+                self._mmap = mmap.mmap(self._fd, 0, access=mmap.ACCESS_READ)
+                self._view = memoryview(self._mmap)
+
+            major = struct.unpack(">Q", pread(self._fd, 8, 4))[0]
             if major != 1:
                 raise UpdateImageException("Unsupported version")
 
-            size = struct.unpack(">Q", f.read(8))[0]
-            data = f.read(size)
+            size = struct.unpack(">Q", pread(self._fd, 8, 12))[0]
+            data = pread(self._fd, size, 20)
             self._manifest: DeltaArchiveManifest = DeltaArchiveManifest.FromString(data)  # pyright: ignore[reportUnknownMemberType]
-            self._offset: int = f.tell()
+            self._offset: int = 20 + size
+            self._table: BlobTable = BlobTable(
+                self._manifest.partition_operations,  # pyright: ignore[reportUnknownMemberType, reportUnknownArgumentType]
+                self.block_size,
+            )
+            self._verified = bytearray((len(self._table) + 7) // 8)
+            if self._disk_cache is not None:
+                stat = os.fstat(self._fd)
+                # A replaced or modified update file gets a new, empty ledger
+                self._ledger_key = (
+                    f"{stat.st_size:x}-{stat.st_mtime_ns:x}-{stat.st_ino:x}-verified"
+                )
+                self._load_ledger()
 
-        self._size: int = 0
-        for _, _, length, _ in self._blobs:  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
-            self._size += length
+        except BaseException:
+            self.close()
+            raise
 
-    def verify(self, publickey: bytes) -> None:
-        _publickey = load_pem_public_key(publickey)
-        with open(self.update_file, "rb") as f:
-            data = f.read(self._offset + self._manifest.signatures_offset)  # pyright: ignore[reportUnknownArgumentType, reportUnknownMemberType]
+        self._size: int = self._table.size
 
-        actual_hash = sha256(data).digest()
+    def verify(
+        self,
+        publickey: bytes,
+        progress: Callable[[int, int, float], None] | None = None,
+        chunk_size: int = CHUNK_SIZE,
+    ) -> None:
+        """Verify the signature, calling progress(done, total, elapsed) per chunk"""
+        _publickey = load_pem_public_key(publickey)
+        total = cast(int, self._offset + self._manifest.signatures_offset)  # pyright: ignore[reportUnknownMemberType]
+        hasher = sha256()
+        start = time.monotonic()
+        done = 0
+        while done < total:
+            data = self._payload(done, min(chunk_size, total - done))
+            if not data:
+                raise UpdateImageException("Unexpected EOF while verifying")
+
+            hasher.update(data)
+            done += len(data)
+            if progress is not None:
+                progress(done, total, time.monotonic() - start)
+
+        actual_hash = hasher.digest()
         signature = self.signature
         assert signature is not None
         signed_hash = _publickey.recover_data_from_signature(  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType, reportAttributeAccessIssue]
@@ -131,6 +624,112 @@ class ProtobufUpdateImage(io.RawIOBase):
                 actual_hash,
             )
 
+    def verify_blobs(
+        self,
+        jobs: int | None = None,
+        chunk_size: int = CHUNK_SIZE,
+        force: bool = False,
+    ) -> dict[int, bool]:
+        """Check the payload hash of every blob, returns whether each one matched"""
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+
+        def verify_blob(index: int) -> bool:
+            if not force and self.is_verified(index):
+                return True
+
+            # MOVE operations have no payload to check
+            if not self._table.data_lengths[index] and not self._table.hashes[index]:
+                return True
+
+            offset = self._offset + self._table.data_offsets[index]
+            length = self._table.data_lengths[index]
+            hasher = sha256()
+            with timer(self._stats, "sha256", index):
+                done = 0
+                while done < length:
+                    data = self._payload(offset + done, min(chunk_size, length - done))
+                    if not data:
+                        return False
+
+                    hasher.update(data)
+                    done += len(data)
+
+            if hasher.digest() != self._table.hashes[index]:
+                return False
+
+            with self._lock:
+                self._mark_verified(index)
+
+            return True
+
+        indexes = range(len(self._table))
+        if jobs <= 1:
+            return {index: verify_blob(index) for index in indexes}
+
+        with ThreadPoolExecutor(
+            max_workers=jobs,
+            thread_name_prefix=f"{type(self).__name__}-verify",
+        ) as executor:
+            return dict(zip(indexes, executor.map(verify_blob, indexes)))
+
+    def extract_to(
+        self, path: str, jobs: int | None = None, sparse: bool = False
+    ) -> int:
+        """Write the raw image to path on jobs processes (spawn needs a main guard)"""
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+
+        _create_output(path, self._size)
+        batches = self._table.batches(jobs * 4)
+        if jobs <= 1:
+            written = sum(
+                _extract_blobs(
+                    self.update_file,
+                    self._offset,
+                    path,
+                    rows,
+                    sparse=sparse,
+                    block_size=self.block_size,
+                )
+                for rows in batches
+            )
+
+        else:
+            with ProcessPoolExecutor(max_workers=jobs) as executor:
+                futures = [
+                    executor.submit(
+                        _extract_blobs,
+                        self.update_file,
+                        self._offset,
+                        path,
+                        rows,
+                        sparse=sparse,
+                        block_size=self.block_size,
+                    )
+                    for rows in batches
+                ]
+                written = sum(future.result() for future in futures)
+
+        deltas = [x for x in range(len(self._table)) if self._table.is_delta(x)]
+        if deltas:
+            # Delta operations need the base image, apply them in this process
+            fd = os.open(path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+            try:
+                for index in deltas:
+                    written += _write_extents(
+                        fd,
+                        self._read_blob(index),
+                        self._table.row(index)[0],
+                        sparse,
+                        self.block_size,
+                    )
+
+            finally:
+                os.close(fd)
+
+        return written
+
     @property
     def block_size(self) -> int:
         return self._manifest.block_size  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
@@ -145,83 +744,306 @@ class ProtobufUpdateImage(io.RawIOBase):
 
     @property
     def _signatures(self) -> Generator[Signatures.Signature]:  # pyright: ignore[reportUnknownParameterType, reportUnknownMemberType]
-        with open(self.update_file, "rb") as f:
-            _ = f.seek(self._offset + self._manifest.signatures_offset)  # pyright: ignore[reportUnknownArgumentType, reportUnknownMemberType]
-            yield from Signatures.FromString(  # pyright: ignore[reportUnknownMemberType]
-                f.read(self._manifest.signatures_size)  # pyright: ignore[reportUnknownArgumentType, reportUnknownMemberType]
-            ).signatures
+        yield from Signatures.FromString(  # pyright: ignore[reportUnknownMemberType]
+            pread(
+                self._fd,
+                self._manifest.signatures_size,  # pyright: ignore[reportUnknownArgumentType, reportUnknownMemberType]
+                self._offset + self._manifest.signatures_offset,  # pyright: ignore[reportUnknownArgumentType, reportUnknownMemberType]
+            )
+        ).signatures
 
-    @property
-    def _blobs(self) -> Generator[tuple[InstallOperation, int, int, io.BufferedReader]]:  # pyright: ignore[reportUnknownParameterType]
-        with open(self.update_file, "rb") as f:
-            for blob in self._manifest.partition_operations:  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
-                _ = f.seek(self._offset + blob.data_offset)  # pyright: ignore[reportUnknownArgumentType, reportUnknownMemberType]
-                dst_offset = cast(
-                    int,
-                    blob.dst_extents[0].start_block * self.block_size,  # pyright: ignore[reportUnknownMemberType]
+    def _payload(self, offset: int, size: int) -> bytes | memoryview:
+        """Read size bytes at offset, a slice of the mapping when mapped"""
+        if self._view is not None:
+            return self._view[offset : offset + size]
+
+        return pread(self._fd, size, offset)
+
+    def _mapped(self, index: int) -> bool:
+        """Whether blob index is served straight from the mapping"""
+        if self._view is None:
+            return False
+
+        return self._table.types[index] == cast(int, InstallOperation.Type.REPLACE)  # pyright: ignore[reportUnknownMemberType]
+
+    def _map_blob(self, index: int) -> memoryview:
+        """Return REPLACE blob index as a slice of the mapping, without caching it"""
+        data = self._payload(
+            self._offset + self._table.data_offsets[index],
+            self._table.data_lengths[index],
+        )
+        assert isinstance(data, memoryview)
+        if not self.is_verified(index):
+            _check_hash(data, self._table.hashes[index], stats=self._stats, index=index)
+            with self._lock:
+                self._mark_verified(index)
+
+        assert len(data) <= self._table.lengths[index]
+        self._stats.add("mmap_reads", blob=index)
+        return data
+
+    def _read_blob(self, index: int) -> bytes | memoryview:
+        """Return the decoded data of blob index, decoding it only once"""
+        if self._mapped(index):
+            return self._map_blob(index)
+
+        with self._lock:
+            data = self._cache.get(index)
+            future = self._pending.get(index) if data is None else None
+            owner = data is None and future is None
+            if owner:
+                future = self._pending[index] = Future()
+
+        if data is not None:
+            self._stats.add("cache_hits", blob=index)
+            return data
+
+        assert future is not None
+        if owner:
+            self._stats.add("cache_misses", blob=index)
+            self._fill(index, future)
+
+        return future.result()
+
+    def _fill(self, index: int, future: Future[bytes]) -> None:
+        """Decode blob index into the cache and resolve future with it"""
+        try:
+            data = self._load_blob(index)
+
+        except BaseException as e:  # noqa: BLE001
+            with self._lock:
+                del self._pending[index]
+
+            future.set_exception(e)
+            return
+
+        with self._lock:
+            if self._cache.will_fit(data):
+                self._cache[index] = data
+
+            del self._pending[index]
+
+        future.set_result(data)
+
+    def _load_blob(self, index: int) -> bytes:
+        if self._table.is_delta(index):
+            return self._apply_delta(index)
+
+        blob_length = self._table.lengths[index]
+        blob_type = self._table.types[index]
+        key = self._table.hashes[index].hex()
+        blob_data = None
+        # Only compressed blobs are worth keeping on disk, REPLACE data is
+        # already stored as is in the update file
+        disk_cache = (
+            self._disk_cache
+            if key and blob_type == InstallOperation.Type.REPLACE_BZ  # pyright: ignore[reportUnknownMemberType]
+            else None
+        )
+        if disk_cache is not None:
+            blob_data = _cache_get(disk_cache, key, self._stats, index=index)
+            if blob_data is not None and len(blob_data) > blob_length:
+                blob_data = None
+
+            if blob_data is not None:
+                self._stats.add("disk_cache_hits", blob=index)
+
+        if blob_data is None:
+            data = pread(
+                self._fd,
+                self._table.data_lengths[index],
+                self._offset + self._table.data_offsets[index],
+            )
+            self._stats.add("bytes_read", len(data), index)
+            blob_data = _decode_blob(
+                data,
+                blob_type,
+                blob_length,
+                self._table.hashes[index],
+                stats=self._stats,
+                index=index,
+                verified=self.is_verified(index),
+            )
+            with self._lock:
+                self._mark_verified(index)
+
+            if disk_cache is not None:
+                _cache_set(disk_cache, key, blob_data, self._stats, index=index)
+
+        # Short data is not padded, the rest of the blob reads as zeros
+        assert len(blob_data) <= blob_length
+        return blob_data
+
+    def _source(self, index: int) -> bytes:
+        """Read the src extents of blob index from the base image"""
+        assert self._base is not None
+        data = bytearray()
+        for offset, length in self._table.sources(index):
+            if offset == SPARSE_HOLE:
+                data += bytes(length)
+                continue
+
+            chunk = self._base.read_at(offset, length)
+            if len(chunk) != length:
+                raise UpdateImageException(
+                    f"Error: Src extent {offset}+{length} is outside the base image"
                 )
-                dst_length = cast(int, blob.dst_extents[0].num_blocks * self.block_size)  # pyright: ignore[reportUnknownMemberType]
-                if blob.type not in (0, 1):  # pyright: ignore[reportUnknownMemberType]
-                    raise UpdateImageException(f"Unsupported type {blob.type}")  # pyright: ignore[reportUnknownMemberType]
 
-                yield blob, dst_offset, dst_length, f
+            data += chunk
 
-        self.expire()
+        del data[self._table.source_sizes[index] :]
+        return bytes(data)
 
-    def _read_blob(
-        self,
-        blob: InstallOperation,  # pyright: ignore[reportUnknownParameterType]
-        blob_offset: int,
-        blob_length: int,
-        f: io.BufferedReader,
-    ) -> bytes:
-        if blob_offset in self._cache:
-            return self._cache[blob_offset]
-
-        if blob.type not in (  # pyright: ignore[reportUnknownMemberType]
-            InstallOperation.Type.REPLACE,  # pyright: ignore[reportUnknownMemberType]
-            InstallOperation.Type.REPLACE_BZ,  # pyright: ignore[reportUnknownMemberType]
-        ):
-            raise NotImplementedError(
-                f"Error: {InstallOperation.Type.keys()[blob.type]} has not been implemented yet"  # pyright: ignore[reportUnknownMemberType]
+    def _apply_delta(self, index: int) -> bytes:
+        """Apply MOVE or BSDIFF blob index to the base image"""
+        if self._base is None:
+            raise UpdateImageException(
+                f"Error: Blob {index} is a delta operation and needs a base image"
+            )
+
+        with timer(self._stats, "source", index):
+            blob_data = self._source(index)
+
+        if self._table.types[index] == InstallOperation.Type.BSDIFF:  # pyright: ignore[reportUnknownMemberType]
+            data = pread(
+                self._fd,
+                self._table.data_lengths[index],
+                self._offset + self._table.data_offsets[index],
             )
+            self._stats.add("bytes_read", len(data), index)
+            if not self.is_verified(index):
+                _check_hash(
+                    data, self._table.hashes[index], stats=self._stats, index=index
+                )
 
-        blob_data = f.read(blob.data_length)  # pyright: ignore[reportUnknownMemberType, reportUnknownArgumentType]
-        if sha256(blob_data).digest() != blob.data_sha256_hash:  # pyright: ignore[reportUnknownMemberType]
-            raise UpdateImageException("Error: Data has wrong sha256sum")
+            with self._lock:
+                self._mark_verified(index)
 
-        if blob.type == InstallOperation.Type.REPLACE_BZ:  # pyright: ignore[reportUnknownMemberType]
             try:
-                blob_data = bz2.decompress(blob_data)
+                with timer(self._stats, "bspatch", index):
+                    blob_data = bsdiff.patch(blob_data, data)
 
             except ValueError as err:
                 raise UpdateImageException(f"Error: {err}") from err
 
-            if blob_length - len(blob_data) < 0:
-                raise UpdateImageException(
-                    f"Error: Bz2 compressed data was too large {len(blob_data)}"
-                )
+        if len(blob_data) > self._table.lengths[index]:
+            raise UpdateImageException(
+                f"Error: Delta output was too large {len(blob_data)}"
+            )
 
-        # Zero padd data to fit
-        if len(blob_data) < blob_length:
-            blob_data += b"\0" * (blob_length - len(blob_data))
+        return blob_data
 
-        assert len(blob_data) == blob_length
-        if self._cache.will_fit(blob_data):
-            self._cache[blob_offset] = blob_data
+    def _start_readahead(self, offset: int) -> None:
+        """Decode the next readahead blobs after offset in the background"""
+        blobs: list[tuple[int, Future[bytes]]] = []
+        with self._lock:
+            for index in self._table.following(offset, self.readahead):
+                if (
+                    not self._mapped(index)
+                    and index not in self._cache
+                    and index not in self._pending
+                ):
+                    future: Future[bytes] = Future()
+                    self._pending[index] = future
+                    blobs.append((index, future))
+
+        if not blobs:
+            return
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix=f"{type(self).__name__}-readahead",
+            )
 
-        return blob_data
+        for index, future in blobs:
+            self._stats.add("readahead", blob=index)
+            task = self._executor.submit(self._fill, index, future)
+            task.add_done_callback(
+                functools.partial(self._readahead_done, index, future)
+            )
 
-    @property
-    def cache(self) -> BlockCache:
-        return self._cache
+    def _readahead_done(
+        self, index: int, future: Future[bytes], task: Future[None]
+    ) -> None:
+        if task.cancelled():
+            with self._lock:
+                _ = self._pending.pop(index, None)
+
+            _ = future.cancel()
+
+    def is_verified(self, index: int) -> bool:
+        """Whether the payload hash of blob index has already been checked"""
+        return bool(self._verified[index >> 3] & (1 << (index & 7)))
+
+    def _mark_verified(self, index: int) -> None:
+        if not self.is_verified(index):
+            self._verified[index >> 3] |= 1 << (index & 7)
+            self._verified_changed = True
+
+    def _load_ledger(self) -> None:
+        """Load the verified blobs recorded in the disk cache for this file"""
+        if self._disk_cache is None or self._ledger_key is None:
+            return
+
+        data = _cache_get(self._disk_cache, self._ledger_key, self._stats)
+        if data is not None and len(data) == len(self._verified):
+            self._verified[:] = bytes(a | b for a, b in zip(self._verified, data))
+
+    def _save_ledger(self) -> None:
+        if (
+            self._disk_cache is None
+            or self._ledger_key is None
+            or not self._verified_changed
+        ):
+            return
+
+        # Merge with the ledger saved by any other reader of the same file
+        self._load_ledger()
+        _cache_set(
+            self._disk_cache,
+            self._ledger_key,
+            bytes(self._verified),
+            self._stats,
+            replace=True,
+        )
+        self._verified_changed = False
 
     @property
     def size(self) -> int:
         return self._size
 
     def expire(self) -> None:
-        _ = self._cache.expire()
+        with self._lock:
+            _ = self._cache.expire()
+
+    @override
+    def close(self) -> None:
+        try:
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
+
+            with contextlib.suppress(OSError):
+                self._save_ledger()
+
+            if self._view is not None:
+                self._view.release()
+                self._view = None
+
+            if self._mmap is not None:
+                # Slices handed out keep the mapping open until released
+                with contextlib.suppress(BufferError):
+                    self._mmap.close()
+
+                self._mmap = None
+
+            if self._fd >= 0:
+                os.close(self._fd)
+                self._fd = -1
+
+        finally:
+            super().close()
 
     @override
     def writable(self) -> bool:
@@ -264,9 +1086,23 @@ class ProtobufUpdateImage(io.RawIOBase):
     @override
     def read(self, size: int = -1) -> bytes:
         res = self.peek(size)
-        _ = self.seek(len(res), whence=os.SEEK_CUR)
+        self._advance(len(res))
         return res
 
+    @override
+    def readinto(self, buffer: Buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        size = self._read_into(self._pos, view)
+        self._advance(size)
+        return size
+
+    def _advance(self, size: int) -> None:
+        """Move past size bytes just read, starting readahead if sequential"""
+        offset = self._pos
+        self._pos = min(offset + size, self._size)
+        if self.readahead > 0 and size and self._sequential.update(offset, size):
+            self._start_readahead(self._pos)
+
     def peek(self, size: int = 0) -> bytes:
         offset = self._pos
         if offset >= self._size:
@@ -276,176 +1112,299 @@ class ProtobufUpdateImage(io.RawIOBase):
             size = self._size - offset
 
         res = bytearray(size)
-        for blob, blob_offset, blob_length, f in self._blobs:  # pyright: ignore[reportUnknownVariableType, reportUnknownMemberType]
-            if not range_contains(
-                range(offset, offset + size),
-                range(blob_offset, blob_offset + blob_length),
-            ):
-                if size >= self._size:
-                    print(f"Skipping blob {blob_offset} to {blob_length}, {offset}")
+        _ = self._read_into(offset, memoryview(res))
+        return bytes(res)
 
-                continue
+    def read_at(self, offset: int, size: int) -> bytes:
+        """Read up to size bytes at offset without using the cursor, thread-safe"""
+        if offset < 0:
+            raise ValueError("offset can't be negative")
 
-            blob_data = self._read_blob(blob, blob_offset, blob_length, f)  # pyright: ignore[reportUnknownMemberType, reportUnknownArgumentType]
-            blob_start_offset = max(offset - blob_offset, 0)
-            blob_end_offset = min(offset - blob_offset + size, blob_length)
-            data = blob_data[blob_start_offset:blob_end_offset]
+        res = bytearray(max(min(size, self._size - offset), 0))
+        _ = self._read_into(offset, memoryview(res))
+        return bytes(res)
 
-            assert blob_start_offset >= 0, (
-                f"blob start offset is negative number: {blob_start_offset}"
-            )
-            assert blob_end_offset <= blob_length, (
-                f"blob end offset is larger than blob length: {blob_end_offset}, {blob_length}"
-            )
-            assert blob_end_offset - blob_start_offset == len(data), (
-                f"blob start and end is larger than data: {blob_end_offset - blob_start_offset}, {len(data)}"
+    def _read_into(self, offset: int, buffer: memoryview) -> int:
+        """Copy the image data at offset into buffer, returns the bytes copied"""
+        if offset >= self._size:
+            return 0
+
+        size = min(len(buffer), self._size - offset)
+        filled = 0
+        for extent in self._table.overlapping(offset, offset + size):
+            extent_offset = self._table.extent_offsets[extent]
+            extent_length = self._table.extent_lengths[extent]
+            index = self._table.extent_blobs[extent]
+            blob_offset = self._table.extent_blob_offsets[extent]
+            blob_data = memoryview(self._read_blob(index))
+            extent_start_offset = max(offset - extent_offset, 0)
+            extent_end_offset = min(offset - extent_offset + size, extent_length)
+            data = blob_data[
+                blob_offset + extent_start_offset : blob_offset + extent_end_offset
+            ]
+
+            assert extent_end_offset - extent_start_offset >= len(data), (
+                f"extent start and end is smaller than data: {extent_end_offset - extent_start_offset}, {len(data)}"
                 + f"\n  offset: {offset}"
-                + f"\n  blob_offset: {blob_offset}"
+                + f"\n  extent_offset: {extent_offset}"
                 + f"\n  size: {size}"
-                + f"\n  blob_length: {blob_length}"
-                + f"\n  blob_start_offset: {blob_start_offset}"
-                + f"\n  blob_end_offset: {blob_end_offset}"
+                + f"\n  extent_length: {extent_length}"
+                + f"\n  extent_start_offset: {extent_start_offset}"
+                + f"\n  extent_end_offset: {extent_end_offset}"
+                + f"\n  blob_offset: {blob_offset}"
                 + f"\n  len(blob_data): {len(blob_data)}"
-                + f"\n  blob.type: {blob.type}"  # pyright: ignore[reportUnknownMemberType]
+                + f"\n  blob.type: {self._table.types[index]}"
             )
 
-            start_offset = blob_offset + blob_start_offset - offset
-            end_offset = blob_offset + blob_end_offset - offset
-            res[start_offset:end_offset] = data
+            start_offset = extent_offset + extent_start_offset - offset
+            end_offset = extent_offset + extent_end_offset - offset
 
-            assert start_offset >= 0, f"start offset is negative number: {start_offset}"
-            assert start_offset < len(res), (
-                f"start offset is larger than size of data: {start_offset}, {len(res)}"
-            )
-            assert end_offset <= blob_offset + blob_length, (
-                f"end offset is larger than size of blob: {end_offset}, {blob_offset + blob_length}"
-            )
-            assert end_offset - start_offset == len(data), (
-                f"size of offsets does not equal size of data, {end_offset - start_offset}, {len(data)}"
+            assert start_offset >= filled, (
+                f"start offset overlaps previous extent: {start_offset}, {filled}"
             )
-            assert end_offset <= len(res), (
-                f"end offset is larger than size of data, {end_offset}, {len(res)}"
+            assert end_offset <= size, (
+                f"end offset is larger than size of data, {end_offset}, {size}"
             )
-            assert res[start_offset:end_offset] == data, "data does not match"
+            # Unmapped ranges and data missing from short blobs read as zeros
+            _zero_fill(buffer[filled:start_offset])
+            buffer[start_offset : start_offset + len(data)] = data
+            filled = start_offset + len(data)
+
+        _zero_fill(buffer[filled:size])
+        self.expire()
+        return size
 
-        assert len(res) == size, (
-            f"size of data does not match expected size: {len(res)}, {size}"
-        )
-        return bytes(res)
 
+class CPIOImage(CachedImage):
+    """One image of a swupdate archive as a read only block device"""
 
-class CPIOUpdateImage(io.RawIOBase):
     def __init__(
-        self, update_file: str, cache_size: int = 500, cache_ttl: int = 60
+        self,
+        update_file: str,
+        entry: Entry,
+        lock: threading.RLock,
+        cache_size: int = 500,
+        cache_ttl: int = 60,
+        *,
+        key: str | None = None,
+        disk_cache: DiskCache | None = None,
+        cache_policy: str = "ttl",
+        readahead: int = 4,
     ) -> None:
+        self._stats: Stats = Stats()
         self.update_file: str = update_file
         self.cache_size: int = cache_size
         self._cache: BlockCache = BlockCache(
             maxsize=cache_size * 1024 * 1024,
             ttl=cache_ttl,
+            policy=cache_policy,
+            on_evict=self._on_evict,
         )
-        self._archive: Archive = Archive(self.update_file)
-        self._archive.open()
-        if b"sw-description" not in self._archive.keys():  # noqa: SIM118
-            raise UpdateImageException("Not a swupdate file")
+        self._disk_cache: DiskCache | None = disk_cache
+        self._pos: int = 0
+        # Shared by every image of the archive, held while using its file object
+        self._lock: threading.RLock = lock
+        # Protects the cache and the pages that are being read
+        self._cache_lock: threading.Lock = threading.Lock()
+        self._pending: dict[int, Future[bytes]] = {}
+        self._executor: ThreadPoolExecutor | None = None
+        self._sequential: SequentialDetector = SequentialDetector()
+        self._readahead_page: int = 0
+        self.readahead: int = readahead
+        self._indexed: threading.Event = threading.Event()
+        self._index_error: Exception | None = None
+        self._index_thread: threading.Thread | None = None
+        self._closing: bool = False
+        self._entry: Entry = entry
+        # Disk cache key of the seek index
+        self._key: str | None = key
+        self._image: GzipFile | None = None
+        with self._lock:
+            _ = entry.seek(0)
+            self._compressed: bool = entry.peek(2) == b"\x1f\x8b"
+            # The gzip ISIZE trailer only covers the last member, modulo 2**32,
+            # so the size of a compressed image is only known once indexed
+            self._size: int | None = None
+            if not self._compressed:
+                self._size = len(entry)
+                self._indexed.set()
 
-        description = self._archive["sw-description"]
-        assert description is not None
-        info = cast(
-            dict[str, dict[str, Any]],  # pyright: ignore[reportExplicitAny]
-            libconf.loads(description.read().decode("utf-8")),  # pyright: ignore[reportUnknownMemberType]
-        )["software"]
-        self._version: str = cast(str, info.get("version"))
-
-        self._hardware_type: str
-        self._info: Any  # pyright: ignore[reportExplicitAny]
-        if "reMarkable1" in info:
-            self._hardware_type = "reMarkable1"
-            self._info = info["reMarkable1"]
-
-        elif "reMarkable2" in info:
-            self._hardware_type = "reMarkable2"
-            self._info = info["reMarkable2"]
-
-        elif "ferrari" in info:
-            self._hardware_type = "ferrari"
-            self._info = info["ferrari"]
-
-        elif "chiappa" in info:
-            self._hardware_type = "chiappa"
-            self._info = info["chiappa"]
-
-        elif "tatsu" in info:
-            self._hardware_type = "tatsu"
-            self._info = info["tatsu"]
+    @property
+    def name(self) -> str:
+        return self._entry.name.decode("utf-8")
+
+    def _open(self) -> GzipFile:  # pyright: ignore[reportUnknownParameterType]
+        """Open the gzip stream on first use and start indexing it"""
+        with self._lock:
+            image = self._image  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
+            if image is not None:
+                return image  # pyright: ignore[reportUnknownVariableType]
+
+            image = self._open_image(self._entry, self._key)  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
+            self._image = image
+            if self._indexed.is_set():
+                self._size = cast(int, image.seek(0, io.SEEK_END))  # pyright: ignore[reportUnknownMemberType]
+
+            else:
+                self._index_thread = threading.Thread(
+                    target=self._build_index,
+                    args=(self._key,),
+                    name=f"{type(self).__name__}-index",
+                    daemon=True,
+                )
+                self._index_thread.start()
+
+            return image  # pyright: ignore[reportUnknownVariableType]
+
+    def _open_image(self, entry: Entry, key: str | None) -> GzipFile:  # pyright: ignore[reportUnknownParameterType]
+        """Open entry as a gzip stream, importing its cached seek index if any"""
+        index = None
+        if self._disk_cache is not None and key is not None:
+            index = _cache_get(self._disk_cache, key, self._stats)
+
+        if index is not None:
+            assert self._disk_cache is not None and key is not None
+            image = GzipFile(fileobj=entry, mode="rb")  # pyright: ignore[reportUnknownVariableType]
+            try:
+                image.import_index(fileobj=io.BytesIO(index))  # pyright: ignore[reportUnknownMemberType]
+                self._indexed.set()
+                return image  # pyright: ignore[reportUnknownVariableType]
+
+            except (OSError, ValueError):
+                image.close()  # pyright: ignore[reportUnknownMemberType]
+                # Drop the broken index so the rebuilt one can take its place
+                try:
+                    self._disk_cache.delete(key)
+
+                except OSError:
+                    self._stats.add("disk_cache_errors")
+
+        return GzipFile(fileobj=entry, mode="rb")  # pyright: ignore[reportUnknownVariableType]
+
+    def _build_index(self, key: str | None) -> None:
+        """Extend the seek index one step at a time, only locking for each step"""
+        image = self._image  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
+        assert image is not None
+        data = io.BytesIO()
+        try:
+            target = 0
+            while not self._closing:
+                target += INDEX_STEP
+                with self._lock:
+                    reached = cast(int, image.seek(target))  # pyright: ignore[reportUnknownMemberType]
+
+                if reached < target:
+                    break
+
+            if self._closing:
+                return
+
+            with self._lock:
+                self._size = cast(int, image.seek(0, io.SEEK_END))  # pyright: ignore[reportUnknownMemberType]
+                if key is not None:
+                    image.export_index(fileobj=data)  # pyright: ignore[reportUnknownMemberType]
+
+        except Exception as e:  # noqa: BLE001
+            self._index_error = e
 
         else:
-            raise UpdateImageException("Unsupported swupdate file")
-
-        # TODO - handle non-stable images
-        # TODO - handle possibilities of multiple images
-        entry = self._archive[self._info["stable"]["copy1"]["images"][0]["filename"]]  # pyright: ignore[reportAny]
-        self._image: GzipFile = GzipFile(fileobj=entry, mode="rb")
-        # Read entire image to allow seeking based on io.SEEK_END
-        while self._image.read(131_672):  # pyright: ignore[reportUnknownMemberType]
-            pass
+            if key is not None and self._disk_cache is not None:
+                _cache_set(self._disk_cache, key, data.getvalue(), self._stats)
 
-        _ = self._image.seek(0, io.SEEK_SET)  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
+        finally:
+            self._indexed.set()
 
-    def verify(self, _publickey: str) -> None:
-        # TODO - verify signature
-        def verify_hash(expected_hash: str, entry: Entry) -> None:
-            actual_hash = sha256(entry.peek()).hexdigest()
-            if expected_hash != actual_hash:
-                raise UpdateImageException(
-                    "Actual hash does not match metadata hash",
-                    expected_hash,
-                    actual_hash,
-                )
+    def wait_indexed(self, timeout: float | None = None) -> bool:
+        """Wait for the background seek index build, opening the image if needed"""
+        if self._compressed:
+            _ = self._open()  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
 
-        def verify_copy(copy: dict[str, list[dict[str, str]]]) -> None:
-            for image in (
-                copy["images"] + copy.get("files", []) + copy.get("scripts", [])
-            ):
-                archive = self._archive[image["filename"]]
-                assert archive is not None
-                verify_hash(image["sha256"], archive)
+        if not self._indexed.wait(timeout):
+            return False
 
-        for copy in ("copy1", "copy2"):
-            verify_copy(self._info["stable"][copy])  # pyright: ignore[reportAny]
+        if self._index_error is not None:
+            raise UpdateImageException(
+                f"Error: Failed to index image: {self._index_error}"
+            ) from self._index_error
 
-    @property
-    def signature(self) -> str | None:
-        # TODO - get from entry
-        return None
+        return True
 
-    @property
-    def version(self) -> str | None:
-        return self._version
+    def _read_image(self, offset: int, size: int) -> bytes:
+        if not self._compressed:
+            with self._lock:
+                self._entry.seek(offset)
+                return self._entry.peek(size) if size > 0 else b""
+
+        image = self._open()  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
+        with self._lock, self._stats.time("gzip"):
+            _ = image.seek(offset)  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
+            data = cast(bytes, image.read(size))  # pyright: ignore[reportUnknownMemberType]
+
+        self._stats.add("bytes_decompressed", len(data))
+        return data
+
+    def extract_to(
+        self, path: str, jobs: int | None = None, sparse: bool = False
+    ) -> int:
+        """Write the raw image to path, jobs is unused as gzip is sequential"""
+        _ = jobs
+        size = self.size
+        _create_output(path, size)
+        written = 0
+        fd = os.open(path, os.O_WRONLY | getattr(os, "O_BINARY", 0))
+        try:
+            offset = 0
+            while offset < size:
+                data = self._read_image(offset, CHUNK_SIZE)
+                if not data:
+                    break
 
-    @property
-    def hardware_type(self) -> str:
-        return self._hardware_type
+                written += _write_data(fd, data, offset, sparse, 4096)
+                offset += len(data)
 
-    @property
-    def archive(self) -> Archive:
-        return self._archive
+        finally:
+            os.close(fd)
 
-    @property
-    def cache(self) -> BlockCache:
-        return self._cache
+        return written
+
+    @override
+    def stats(self) -> dict[str, object]:
+        stats = super().stats()
+        stats["bytes_read"] = self._entry.bytes_read
+        return stats
+
+    @override
+    def reset_stats(self) -> None:
+        super().reset_stats()
+        self._entry.bytes_read = 0
 
     @property
     def size(self) -> int:
-        return self._image.size  # pyright: ignore[reportUnknownVariableType, reportUnknownMemberType]
+        """Uncompressed size, waits for the seek index of a compressed image"""
+        if self._size is None:
+            _ = self.wait_indexed()
+
+        assert self._size is not None
+        return self._size
 
     def expire(self) -> None:
-        _ = self._cache.expire()
+        with self._cache_lock:
+            _ = self._cache.expire()
 
     @override
     def close(self) -> None:
+        if self.closed:
+            return
+
         try:
-            self._archive.close()
+            self._closing = True
+            if self._index_thread is not None:
+                self._index_thread.join()
+                self._index_thread = None
+
+            if self._executor is not None:
+                self._executor.shutdown(cancel_futures=True)
+                self._executor = None
 
         finally:
             super().close()
@@ -464,34 +1423,500 @@ class CPIOUpdateImage(io.RawIOBase):
 
     @override
     def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
-        return self._image.seek(offset, whence)  # pyright: ignore[reportUnknownVariableType, reportUnknownMemberType]
+        if whence == os.SEEK_SET:
+            pos = offset
+
+        elif whence == os.SEEK_CUR:
+            pos = self._pos + offset
+
+        elif whence == os.SEEK_END:
+            pos = self.size + offset
+
+        else:
+            raise OSError("Not supported whence")
+
+        if pos < 0:
+            raise ValueError("offset can't be negative")
+
+        if self._size is not None:
+            pos = min(pos, self._size)
+
+        self._pos = pos
+        return self._pos
 
     @override
     def tell(self) -> int:
-        return self._image.tell()  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
+        return self._pos
+
+    def _claim_pages(self, page: int, last: int) -> list[Future[bytes]]:
+        """Mark missing pages from page up to last as being read, needs the lock"""
+        futures: list[Future[bytes]] = []
+        while page <= last and page not in self._cache and page not in self._pending:
+            future: Future[bytes] = Future()
+            self._pending[page] = future
+            futures.append(future)
+            page += 1
+
+        return futures
+
+    def _fetch_pages(self, page: int, futures: list[Future[bytes]]) -> bytes:
+        """Read the pages claimed by _claim_pages into the cache"""
+        count = len(futures)
+        try:
+            data = self._read_image(page * PAGE_SIZE, count * PAGE_SIZE)
+
+        except BaseException as e:
+            with self._cache_lock:
+                for index in range(count):
+                    del self._pending[page + index]
+
+            for future in futures:
+                future.set_exception(e)
+
+            raise
+
+        chunks = [
+            data[index * PAGE_SIZE : (index + 1) * PAGE_SIZE] for index in range(count)
+        ]
+        with self._cache_lock:
+            for index, chunk in enumerate(chunks):
+                if chunk and self._cache.will_fit(chunk):
+                    self._cache[page + index] = chunk
+
+                del self._pending[page + index]
+
+        for future, chunk in zip(futures, chunks):
+            future.set_result(chunk)
+
+        return data
+
+    def _read_pages(self, offset: int, buffer: memoryview) -> int:
+        """Copy the image data at offset into buffer through the page cache"""
+        pos = offset
+        stop = offset + len(buffer)
+        page = pos // PAGE_SIZE
+        while pos < stop:
+            futures: list[Future[bytes]] = []
+            with self._cache_lock:
+                data = self._cache.get(page)
+                future = self._pending.get(page) if data is None else None
+                if data is None and future is None:
+                    futures = self._claim_pages(page, (stop - 1) // PAGE_SIZE)
+
+            end = page + max(len(futures), 1)
+            if data is not None:
+                self._stats.add("cache_hits")
+
+            elif future is not None:
+                # Already being read by readahead or another reader
+                data = future.result()
+
+            else:
+                self._stats.add("cache_misses", len(futures))
+                data = self._fetch_pages(page, futures)
+
+            start = pos - page * PAGE_SIZE
+            chunk = memoryview(data)[start : start + stop - pos]
+            buffer[pos - offset : pos - offset + len(chunk)] = chunk
+            pos += len(chunk)
+            if pos < min(stop, end * PAGE_SIZE):
+                break
+
+            page = end
+
+        return pos - offset
+
+    def _start_readahead(self, offset: int) -> None:
+        """Read the readahead chunks after offset in the background"""
+        page = offset // PAGE_SIZE
+        last = (offset + self.readahead * CHUNK_SIZE) // PAGE_SIZE - 1
+        if self._size is not None:
+            last = min(last, (self._size - 1) // PAGE_SIZE)
+
+        # Skip the part of the window that earlier readahead already covers
+        if page < self._readahead_page <= last + 1:
+            page = self._readahead_page
+
+        if page > last:
+            return
+
+        self._readahead_page = last + 1
+        runs: list[tuple[int, list[Future[bytes]]]] = []
+        with self._cache_lock:
+            while page <= last:
+                futures = self._claim_pages(page, last)
+                if futures:
+                    runs.append((page, futures))
+
+                page += max(len(futures), 1)
+
+        if not runs:
+            return
+
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(
+                max_workers=1,
+                thread_name_prefix=f"{type(self).__name__}-readahead",
+            )
+
+        for page, futures in runs:
+            self._stats.add("readahead", len(futures))
+            task = self._executor.submit(self._fetch_pages, page, futures)
+            task.add_done_callback(
+                functools.partial(self._readahead_done, page, futures)
+            )
+
+    def _readahead_done(
+        self, page: int, futures: list[Future[bytes]], task: Future[bytes]
+    ) -> None:
+        if task.cancelled():
+            with self._cache_lock:
+                for index in range(len(futures)):
+                    _ = self._pending.pop(page + index, None)
+
+            for future in futures:
+                _ = future.cancel()
+
+    def _clamp(self, offset: int, size: int) -> int:
+        """Limit size to the end of the image, waiting for it on large reads"""
+        if self._size is None and size > PEEK_SIZE:
+            _ = self.wait_indexed()
+
+        if self._size is not None:
+            size = min(size, self._size - offset)
+
+        return max(size, 0)
 
     @override
     def read(self, size: int = -1) -> bytes:
-        key = (self.tell(), size)
-        if key in self._cache:
-            return self._cache[key]
+        if size < 0:
+            size = max(self.size - self._pos, 0)
 
-        data = self._image.read(size)  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
-        if self._cache.will_fit(data):  # pyright: ignore[reportUnknownArgumentType]
-            self._cache[key] = data
+        res = bytearray(self._clamp(self._pos, size))
+        size = self.readinto(res)
+        del res[size:]
+        return bytes(res)
 
-        return data  # pyright: ignore[reportUnknownVariableType]
+    @override
+    def readinto(self, buffer: Buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        offset = self._pos
+        size = self._read_pages(offset, view)
+        self._pos += size
+        if self.readahead > 0 and size and self._sequential.update(offset, size):
+            self._start_readahead(self._pos)
+
+        return size
+
+    def read_at(self, offset: int, size: int) -> bytes:
+        """Read up to size bytes at offset without using the cursor, thread-safe"""
+        if offset < 0:
+            raise ValueError("offset can't be negative")
+
+        res = bytearray(self._clamp(offset, size))
+        del res[self._read_pages(offset, memoryview(res)) :]
+        return bytes(res)
 
     def peek(self, size: int = 0) -> bytes:
-        key = (self.tell(), size)
-        if key in self._cache:
-            return self._cache[key]
+        """Return at least PEEK_SIZE bytes at the current position, not moving it"""
+        res = bytearray(self._clamp(self._pos, max(size, PEEK_SIZE)))
+        del res[self._read_pages(self._pos, memoryview(res)) :]
+        return bytes(res)
+
+
+class CPIOUpdateImage(CPIOImage):
+    """swupdate archive, read as the first image of stable copy1"""
+
+    def __init__(
+        self,
+        update_file: str,
+        cache_size: int = 500,
+        cache_ttl: int = 60,
+        *,
+        disk_cache: str | None = None,
+        disk_cache_size: int = 2048,
+        cache_policy: str = "ttl",
+        readahead: int = 4,
+        use_mmap: bool = False,
+    ) -> None:
+        self._images: dict[tuple[str, str, str], CPIOImage] | None = None
+        self._mmap: mmap.mmap | None = None
+        archive: Archive | None = None
+        try:
+            if use_mmap:
+                with open(update_file, "rb") as f:
+                    try:
+                        self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+                    except ValueError as e:
+                        raise UpdateImageException(f"Error: {e}") from e
+
+                # Entries read from the mapping instead of making system calls
+                archive = Archive(MappedFile(self._mmap))
+
+            else:
+                archive = Archive(update_file)
+
+            self._archive: Archive = archive
+            self._archive.open()
+            if b"sw-description" not in self._archive.keys():  # noqa: SIM118
+                raise UpdateImageException("Not a swupdate file")
+
+            description = self._archive["sw-description"]
+            assert description is not None
+            info = cast(
+                dict[str, dict[str, Any]],  # pyright: ignore[reportExplicitAny]
+                libconf.loads(description.read().decode("utf-8")),  # pyright: ignore[reportUnknownMemberType]
+            )["software"]
+            self._version: str = cast(str, info.get("version"))
+
+            self._hardware_type: str
+            self._info: Any  # pyright: ignore[reportExplicitAny]
+            if "reMarkable1" in info:
+                self._hardware_type = "reMarkable1"
+                self._info = info["reMarkable1"]
+
+            elif "reMarkable2" in info:
+                self._hardware_type = "reMarkable2"
+                self._info = info["reMarkable2"]
+
+            elif "ferrari" in info:
+                self._hardware_type = "ferrari"
+                self._info = info["ferrari"]
+
+            elif "chiappa" in info:
+                self._hardware_type = "chiappa"
+                self._info = info["chiappa"]
+
+            elif "tatsu" in info:
+                self._hardware_type = "tatsu"
+                self._info = info["tatsu"]
+
+            else:
+                raise UpdateImageException("Unsupported swupdate file")
+
+            self._disk_cache: DiskCache | None = None
+            if disk_cache is not None:
+                self._disk_cache = DiskCache(disk_cache, disk_cache_size * 1024 * 1024)
+
+            self._options: dict[str, Any] = {  # pyright: ignore[reportExplicitAny]
+                "cache_size": cache_size,
+                "cache_ttl": cache_ttl,
+                "disk_cache": self._disk_cache,
+                "cache_policy": cache_policy,
+                "readahead": readahead,
+            }
+            # The first stable image is read directly, images has the others
+            image = cast(dict[str, str], self._info["stable"]["copy1"]["images"][0])
+            entry = self._archive[image["filename"]]
+            assert entry is not None
+            super().__init__(
+                update_file,
+                entry,
+                threading.RLock(),
+                key=self._index_key(image, entry),
+                **self._options,  # pyright: ignore[reportAny]
+            )
+
+        except BaseException:
+            if archive is not None and archive.fileobj is not None:
+                archive.close()
+
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
+
+            # Nothing else is open yet, so __del__ must not call close()
+            io.RawIOBase.close(self)
+            raise
+
+    def _index_key(self, image: dict[str, str], entry: Entry) -> str | None:
+        if self._disk_cache is None or not image.get("sha256"):
+            return None
+
+        return f"{image['sha256']}-{len(entry):x}-gzindex"
+
+    @property
+    def images(self) -> dict[tuple[str, str, str], CPIOImage]:
+        """Every image of the archive by software set, copy and filename"""
+        if self._images is not None:
+            return self._images
+
+        primary = cast(dict[str, str], self._info["stable"]["copy1"]["images"][0])
+        opened: dict[str, CPIOImage] = {primary["filename"]: self}
+        images: dict[tuple[str, str, str], CPIOImage] = {}
+        for set_name, software_set in cast(dict[str, object], self._info).items():
+            if not isinstance(software_set, dict):
+                continue
+
+            for copy_name, copy in cast(dict[str, object], software_set).items():
+                if not isinstance(copy, dict):
+                    continue
+
+                for image in cast(
+                    tuple[dict[str, str], ...],
+                    cast(dict[str, object], copy).get("images", ()),
+                ):
+                    filename = image["filename"]
+                    if filename not in opened:
+                        entry = self._archive[filename]
+                        if entry is None:
+                            raise UpdateImageException(f"Missing entry: {filename}")
+
+                        opened[filename] = CPIOImage(
+                            self.update_file,
+                            entry,
+                            self._lock,
+                            key=self._index_key(image, entry),
+                            **self._options,  # pyright: ignore[reportAny]
+                        )
+
+                    images[set_name, copy_name, filename] = opened[filename]
+
+        self._images = images
+        return images
+
+    def verify(
+        self,
+        publickey: bytes | str,
+        jobs: int | None = None,
+        chunk_size: int = CHUNK_SIZE,
+    ) -> None:
+        """Verify sw-description.sig and the hashes of the entries it lists"""
+        if isinstance(publickey, str):
+            publickey = publickey.encode("utf-8")
+
+        description = self._archive["sw-description"]
+        assert description is not None
+        with self._lock:
+            actual_hash = sha256(description.data).digest()
+
+        signature = self.signature
+        if signature is None:
+            raise UpdateImageSignatureException(
+                "Missing sw-description.sig", b"", actual_hash
+            )
+
+        _publickey = load_pem_public_key(publickey)
+        try:
+            signed_hash = _publickey.recover_data_from_signature(  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType, reportAttributeAccessIssue]
+                signature,
+                PKCS1v15(),
+                SHA256(),
+            )
+
+        except InvalidSignature as e:
+            raise UpdateImageSignatureException(
+                "Invalid sw-description signature", b"", actual_hash
+            ) from e
+
+        if actual_hash != signed_hash:
+            raise UpdateImageSignatureException(
+                "Actual hash does not match signed hash",
+                signed_hash,  # pyright: ignore[reportUnknownArgumentType]
+                actual_hash,
+            )
+
+        entries: dict[str, tuple[str, Entry]] = {}
+        for copy in ("copy1", "copy2"):
+            info = cast(dict[str, Any], self._info["stable"][copy])  # pyright: ignore[reportExplicitAny]
+            for image in cast(
+                list[dict[str, str]],
+                [
+                    *info.get("images", ()),
+                    *info.get("files", ()),
+                    *info.get("scripts", ()),
+                ],
+            ):
+                entry = self._archive[image["filename"]]
+                if entry is None:
+                    raise UpdateImageException(f"Missing entry: {image['filename']}")
+
+                entries[image["filename"]] = (image["sha256"], entry)
+
+        # A private file descriptor so hashing does not contend with reads
+        fd = open_fd(self.update_file)
+
+        def verify_hash(item: tuple[str, Entry]) -> None:
+            expected_hash, entry = item
+            hasher = sha256()
+            done = 0
+            while done < len(entry):
+                data = pread(
+                    fd, min(chunk_size, len(entry) - done), entry.dataoffset + done
+                )
+                if not data:
+                    raise UpdateImageException("Unexpected EOF while verifying")
+
+                hasher.update(data)
+                done += len(data)
+
+            actual_hash = hasher.hexdigest()
+            if expected_hash != actual_hash:
+                raise UpdateImageException(
+                    "Actual hash does not match metadata hash",
+                    expected_hash,
+                    actual_hash,
+                )
+
+        if jobs is None:
+            jobs = os.cpu_count() or 1
+
+        try:
+            jobs = max(min(jobs, len(entries)), 1)
+            if jobs == 1:
+                for item in entries.values():
+                    verify_hash(item)
+
+            else:
+                with ThreadPoolExecutor(
+                    max_workers=jobs,
+                    thread_name_prefix=f"{type(self).__name__}-verify",
+                ) as executor:
+                    for _ in executor.map(verify_hash, entries.values()):
+                        pass
+
+        finally:
+            os.close(fd)
+
+    @property
+    def signature(self) -> bytes | None:
+        entry = self._archive["sw-description.sig"]
+        if entry is None:
+            return None
+
+        with self._lock:
+            return entry.data
 
-        data = self._image.peek(size)  # pyright: ignore[reportUnknownMemberType, reportUnknownVariableType]
-        if self._cache.will_fit(data):  # pyright: ignore[reportUnknownArgumentType]
-            self._cache[key] = data
+    @property
+    def version(self) -> str | None:
+        return self._version
+
+    @property
+    def hardware_type(self) -> str:
+        return self._hardware_type
+
+    @property
+    def archive(self) -> Archive:
+        return self._archive
 
-        return data  # pyright: ignore[reportUnknownVariableType]
+    @override
+    def close(self) -> None:
+        if self.closed:
+            return
+
+        try:
+            for image in (self._images or {}).values():
+                if image is not self:
+                    image.close()
+
+            super().close()
+
+        finally:
+            self._archive.close()
+            if self._mmap is not None:
+                self._mmap.close()
+                self._mmap = None
 
 
 class UpdateImage:
@@ -500,11 +1925,38 @@ class UpdateImage:
         update_file: str,
         cache_size: int = 500,
         cache_ttl: int = 60,
+        *,
+        disk_cache: str | None = None,
+        disk_cache_size: int = 2048,
+        cache_policy: str = "ttl",
+        readahead: int = 4,
+        use_mmap: bool = False,
+        base: ProtobufUpdateImage | CPIOUpdateImage | None = None,
     ) -> ProtobufUpdateImage | CPIOUpdateImage:
+        """Open update_file as whichever image type it is, base is CrAU only"""
         try:
-            return ProtobufUpdateImage(update_file, cache_size, cache_ttl)
+            return ProtobufUpdateImage(
+                update_file,
+                cache_size,
+                cache_ttl,
+                disk_cache=disk_cache,
+                disk_cache_size=disk_cache_size,
+                cache_policy=cache_policy,
+                readahead=readahead,
+                use_mmap=use_mmap,
+                base=base,
+            )
 
         except UpdateImageException:
             pass
 
-        return CPIOUpdateImage(update_file, cache_size, cache_ttl)
+        return CPIOUpdateImage(
+            update_file,
+            cache_size,
+            cache_ttl,
+            disk_cache=disk_cache,
+            disk_cache_size=disk_cache_size,
+            cache_policy=cache_policy,
+            readahead=readahead,
+            use_mmap=use_mmap,
+        )
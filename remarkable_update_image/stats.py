@@ -0,0 +1,57 @@
+import contextlib
+import threading
+import time
+from collections.abc import Callable, Generator
+
+Hook = Callable[[str, float, int | None], None]
+
+
+class Stats:
+    """Counters and timings of an update image, in total and per blob"""
+
+    def __init__(self) -> None:
+        self._lock: threading.Lock = threading.Lock()
+        self.hooks: list[Hook] = []
+        self.totals: dict[str, float] = {}
+        self.blobs: dict[int, dict[str, float]] = {}
+
+    def add(self, name: str, amount: float = 1, blob: int | None = None) -> None:
+        with self._lock:
+            self.totals[name] = self.totals.get(name, 0) + amount
+            if blob is not None:
+                stats = self.blobs.setdefault(blob, {})
+                stats[name] = stats.get(name, 0) + amount
+
+        for hook in list(self.hooks):
+            hook(name, amount, blob)
+
+    @contextlib.contextmanager
+    def time(self, name: str, blob: int | None = None) -> Generator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+
+        finally:
+            self.add(f"{name}_time", time.perf_counter() - start, blob)
+
+    def as_dict(self) -> dict[str, object]:
+        with self._lock:
+            return {
+                **self.totals,
+                "blobs": {k: dict(v) for k, v in self.blobs.items()},
+            }
+
+    def reset(self) -> None:
+        with self._lock:
+            self.totals.clear()
+            self.blobs.clear()
+
+
+def timer(
+    stats: Stats | None, name: str, blob: int | None = None
+) -> contextlib.AbstractContextManager[None]:
+    """Stats.time when stats is set, otherwise a no-op context manager"""
+    if stats is None:
+        return contextlib.nullcontext()
+
+    return stats.time(name, blob)
@@ -2,34 +2,61 @@
 # pyright: reportUnknownMemberType=false
 # pyright: reportUnknownVariableType=false
 # pyright: reportUnknownArgumentType=false
+import asyncio
+import bz2
 import difflib
 import errno
 import os
+import random
+import struct
 import sys
+from concurrent.futures import ThreadPoolExecutor
 from hashlib import (
     md5,
     sha256,
 )
-from tempfile import TemporaryFile
-from typing import Any
+from itertools import pairwise
+from tempfile import TemporaryDirectory, TemporaryFile
+from typing import Any, cast
 
 import ext4
+from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.serialization import (
+    Encoding,
+    PublicFormat,
+)
 from ext4 import (
     ChecksumError,  # pyright: ignore[reportAttributeAccessIssue]
     SymbolicLink,  # pyright: ignore[reportAttributeAccessIssue]
 )
 from ext4.struct import to_hex  # pyright: ignore[reportMissingImports]
 
+from bench import (
+    make_crau,
+    make_image,
+    make_swu,
+)
 from remarkable_update_image import (
+    AsyncUpdateImage,
     UpdateImage,
     UpdateImageSignatureException,
+    bsdiff,
+    iter_entries,
 )
 from remarkable_update_image._compat import FileObj
+from remarkable_update_image.cache import BlockCache
 from remarkable_update_image.image import (
+    SPARSE_HOLE,
     CPIOUpdateImage,
     ProtobufUpdateImage,
+    UpdateImageException,
     sizeof_fmt,
 )
+from remarkable_update_image.update_metadata_pb2 import (
+    DeltaArchiveManifest,  # pyright: ignore[reportAttributeAccessIssue]
+    Extent,  # pyright: ignore[reportAttributeAccessIssue]
+    InstallOperation,  # pyright: ignore[reportAttributeAccessIssue]
+)
 
 FAILED = False
 
@@ -78,6 +105,27 @@ def assert_raw_byte(
     print("pass")
 
 
+def assert_readinto(
+    image: CPIOUpdateImage | ProtobufUpdateImage,
+    offset: int,
+    size: int,
+) -> None:
+    global FAILED
+    print(f"checking readinto at raw offset {offset:08X} matches read: ", end="")
+    _ = image.seek(offset)
+    expected = image.read(size)
+    buffer = bytearray(size)
+    _ = image.seek(offset)
+    count = image.readinto(buffer)
+    if count != len(expected) or bytes(buffer[:count]) != expected:
+        print("fail")
+        FAILED = True
+        print(f"  Error: {count} bytes returned, {len(expected)} expected")
+        return
+
+    print("pass")
+
+
 def assert_exists(volume: ext4.Volume, path: str) -> None:  # pyright: ignore[reportUnknownParameterType]
     global FAILED
     print(f"checking that {path} exists: ", end="")
@@ -215,6 +263,83 @@ def assert_extract(
         print(e)
 
 
+def assert_extract_to(
+    image: CPIOUpdateImage | ProtobufUpdateImage,
+    expected_digest: str,
+    sparse: bool = False,
+) -> None:
+    global FAILED
+    print(f"checking extract_to {image.update_file} {sparse=}: ", end="")
+    try:
+        with TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, "image.ext4")
+            _ = image.extract_to(path, jobs=2, sparse=sparse)
+            with open(path, "rb") as f:
+                digest = sha256(f.read()).hexdigest()
+
+        if expected_digest != digest:
+            raise Exception(f"Incorrect digest: {digest}")  # noqa: TRY002
+
+        print("pass")
+
+    except Exception as e:  # noqa: BLE001
+        FAILED = True
+        print("fail")
+        print("  ", end="")
+        print(e)
+
+
+def assert_read_at_threads(
+    image: CPIOUpdateImage | ProtobufUpdateImage,
+    expected_digest: str,
+) -> None:
+    global FAILED
+    print(f"checking read_at from threads {image.update_file}: ", end="")
+    size = 1024 * 1024
+
+    def read_at(offset: int) -> bytes:
+        return image.read_at(offset, size)
+
+    with ThreadPoolExecutor(max_workers=4) as executor:
+        chunks = executor.map(read_at, range(0, image.size, size))
+        digest = sha256(b"".join(chunks)).hexdigest()
+
+    if expected_digest != digest:
+        print("fail")
+        FAILED = True
+        print(f"  Error: Incorrect digest: {digest}")
+        return
+
+    print("pass")
+
+
+def assert_async_read(path: str, expected_digest: str) -> None:
+    global FAILED
+    print(f"checking async read {path}: ", end="")
+
+    async def read() -> str:
+        async with await AsyncUpdateImage.open(path) as image:
+            return sha256(await image.read()).hexdigest()
+
+    try:
+        digest = asyncio.run(read())
+        if expected_digest != digest:
+            raise Exception(f"Incorrect digest: {digest}")  # noqa: TRY002
+
+        print("pass")
+
+    except Exception as e:  # noqa: BLE001
+        FAILED = True
+        print("fail")
+        print("  ", end="")
+        print(e)
+
+
+async def async_read_at(path: str, offset: int, size: int) -> bytes:
+    async with await AsyncUpdateImage.open(path) as image:
+        return await image.read_at(offset, size)
+
+
 def validate_root_inode(volume: ext4.Volume) -> None:  # pyright: ignore[reportUnknownParameterType]
     global FAILED
     print(f"validating root inode {volume.uuid}: ", end="")
@@ -242,275 +367,854 @@ def assert_value(name: str, value: Any, expected: Any) -> None:  # pyright: igno
     FAILED = True
 
 
-path = ".data/remarkable-production-memfault-image-3.11.3.3-rm1-public"
-with UpdateImage(path) as image:
-    assert_image_type(image, CPIOUpdateImage)
-    assert_attr(image, "version", "3.11.3.3")
-    assert_attr(image, "hardware_type", "reMarkable1")
-    assert_in_archive(image, "sw-description")  # pyright: ignore[reportArgumentType]
-    volume = ext4.Volume(image)
-    validate_root_inode(volume)
-    assert_ls(
-        volume,
-        "/",
-        [
-            ".",
-            "..",
-            "lost+found",
-            "bin",
-            "boot",
-            "dev",
-            "etc",
-            "home",
-            "lib",
-            "media",
-            "mnt",
-            "postinst",
-            "proc",
-            "run",
-            "sbin",
-            "srv",
-            "sys",
-            "tmp",
-            "uboot-version",
-            "usr",
-            "var",
-        ],
-    )
-    assert_ls(
-        volume,
-        "/bin",
-        [
-            ".",
-            "..",
-            "rmdir",
-            "sed",
-            "chgrp",
-            "systemctl",
-            "bash.bash",
-            "mountpoint",
-            "chattr",
-            "stat",
-            "mount",
-            "busybox",
-            "systemd-sysext",
-            "networkctl",
-            "chown",
-            "systemd-tmpfiles",
-            "mktemp",
-            "lsmod",
-            "stty",
-            "kill",
-            "cpio",
-            "true",
-            "gzip",
-            "df",
-            "ps",
-            "systemd-sysusers",
-            "systemd-machine-id-setup",
-            "dnsdomainname",
-            "netstat",
-            "dumpkmap",
-            "su.shadow",
-            "systemd-tty-ask-password-agent",
-            "date",
-            "kmod",
-            "systemd-escape",
-            "ln",
-            "loginctl",
-            "watch",
-            "dmesg",
-            "uname",
-            "dd",
-            "chmod",
-            "busybox.nosuid",
-            "busybox.suid",
-            "usleep",
-            "umount.util-linux",
-            "cp",
-            "more",
-            "login",
-            "journalctl",
-            "ls",
-            "false",
-            "systemd-creds",
-            "ash",
-            "hostname",
-            "touch",
-            "base32",
-            "ping",
-            "sleep",
-            "pidof",
-            "systemd-inhibit",
-            "grep",
-            "tar",
-            "getopt",
-            "zcat",
-            "umount",
-            "egrep",
-            "mknod",
-            "rm",
-            "fgrep",
-            "cat",
-            "sh",
-            "pwd",
-            "vi",
-            "rev",
-            "mkdir",
-            "systemd-hwdb",
-            "gunzip",
-            "sync",
-            "login.shadow",
-            "lsmod.kmod",
-            "systemd-notify",
-            "systemd-ask-password",
-            "su",
-            "systemd-firstboot",
-            "mv",
-            "udevadm",
-            "bash",
-            "echo",
-            "mount.util-linux",
-            "run-parts",
-        ],
-    )
-    assert_symlink_to(volume, "/bin/ash", b"/bin/busybox.nosuid")
-
-cache_size = 1
-raw_cache_size = cache_size * 1024 * 1024
-read_size = raw_cache_size + 1
-with UpdateImage(path, cache_size=cache_size) as image:
-    print(
-        f"checking reading larger than {sizeof_fmt(raw_cache_size)} cache size: ",
-        end="",
-    )
+def assert_verify(
+    image: CPIOUpdateImage | ProtobufUpdateImage,
+    publickey: bytes,
+    valid: bool,
+) -> None:
+    global FAILED
+    print(f"checking signature is {'valid' if valid else 'invalid'}: ", end="")
     try:
-        data = image.read(read_size)
-        data_size = len(data)
-        if data_size != read_size:
-            raise ValueError(
-                f"data returned is not {sizeof_fmt(read_size)}: {sizeof_fmt(data_size)}"
-            )
+        image.verify(publickey)
+        result = True
 
-        print("pass")
+    except UpdateImageSignatureException:
+        result = False
 
-    except ValueError as e:
-        FAILED = True
+    if result != valid:
         print("fail")
-        print("  ", end="")
-        print(e)
+        FAILED = True
+        return
 
-with UpdateImage(".data/2.13.0.758_reMarkable2-2N5B5nvpZ4-.signed") as image:
-    assert_image_type(image, ProtobufUpdateImage)
-    assert_no_attr(image, "version")
-    volume = ext4.Volume(image)
-    validate_root_inode(volume)
-    print("checking image signature: ", end="")
-    try:
-        image.verify(
-            volume.inode_at("/usr/share/update_engine/update-payload-key.pub.pem")
-            .open()
-            .read()
-        )
-        print("pass")
+    print("pass")
 
-    except UpdateImageSignatureException:
-        print("fail")
 
-    assert_value("block count", volume.superblock.s_blocks_count, 261888)
-    assert_value("free block count", volume.superblock.s_free_blocks_count, 38220)
-    assert_value("inode count", volume.superblock.s_inodes_count, 65024)
-    assert_value("free inode count", volume.superblock.s_free_inodes_count, 56414)
-
-    inode = volume.inode_at("/bin/bash.bash")
-    with inode.open() as reader:
-        # Make sure that we aren't reading zeros where there should be a larger block of data
-        assert_byte(reader, 0x00020000, b"\x0c")
-        assert_byte(reader, 0x00020001, b"\x60")
-        assert_byte(reader, 0x00020002, b"\x9d")
-        # Make sure we return a non-zero where a kernel loopback would return data
-        assert_byte(reader, 0x000BBFFF, b"\xe5")
-        assert_byte(reader, 0x000BC000, b"\x54")
-
-    assert_exists(volume, "/bin/bash.bash")
-    assert_exists(volume, "/uboot-version")
-    assert_exists(volume, "/home/root")
-    assert_hash(volume, "21442141a3b145d11763862fcbecc40a", "/uboot-version")
-    assert_hash(volume, "233a2dc8f0ab70fbd956b036438adefb", "/bin/bash.bash")
-    assert_hash(
-        volume,
-        "6a67b9873c57fbb8589ef4a4f744beb3",
-        "/usr/share/update_engine/update-payload-key.pub.pem",
+def write_payload(path: str, operations: list[tuple[InstallOperation, bytes]]) -> None:  # pyright: ignore[reportUnknownParameterType]
+    """Write an unsigned CrAU payload of operations and their data"""
+    manifest = DeltaArchiveManifest(block_size=BLOCK_SIZE)
+    data = b""
+    for operation, payload in operations:
+        if payload:
+            operation.data_offset = len(data)
+            operation.data_length = len(payload)
+            operation.data_sha256_hash = sha256(payload).digest()
+            data += payload
+
+        manifest.partition_operations.append(operation)
+
+    header = manifest.SerializeToString()
+    with open(path, "wb") as f:
+        _ = f.write(b"CrAU" + struct.pack(">QQ", 1, len(header)) + header + data)
+
+
+def make_patch(old: bytes, new: bytes) -> bytes:
+    """BSDIFF40 patch that adds all of new onto old in a single step"""
+    control = bz2.compress(struct.pack("<3Q", len(new), 0, 0))
+    diff = bz2.compress(
+        bytes((x - (old[i] if i < len(old) else 0)) & 0xFF for i, x in enumerate(new))
     )
-    assert_ls(
-        volume,
-        "/",
-        [
-            ".",
-            "..",
-            "lost+found",
-            "bin",
-            "boot",
-            "dev",
-            "etc",
-            "home",
-            "lib",
-            "media",
-            "mnt",
-            "postinst",
-            "proc",
-            "run",
-            "sbin",
-            "sys",
-            "tmp",
-            "uboot-postinst",
-            "uboot-version",
-            "usr",
-            "var",
-        ],
+    extra = bz2.compress(b"")
+    return (
+        b"BSDIFF40"
+        + struct.pack("<3Q", len(control), len(diff), len(new))
+        + control
+        + diff
+        + extra
     )
-    assert_symlink_to(volume, "/bin/ash", b"/bin/busybox.nosuid")
 
-    print("checking path that contains file raises ENOTDIR: ", end="")
-    try:
-        _ = volume.inode_at("/uboot-version/test")
-        print("fail")
-        print("  No error raised")
-        FAILED = True
 
-    except OSError as e:
-        if e.errno == errno.ENOTDIR:
+BLOCK_SIZE = 4096
+
+if __name__ == "__main__":
+    path = ".data/remarkable-production-memfault-image-3.11.3.3-rm1-public"
+    with UpdateImage(path) as image:
+        assert_image_type(image, CPIOUpdateImage)
+        assert_attr(image, "version", "3.11.3.3")
+        assert_attr(image, "hardware_type", "reMarkable1")
+        assert_in_archive(image, "sw-description")  # pyright: ignore[reportArgumentType]
+        volume = ext4.Volume(image)
+        validate_root_inode(volume)
+        assert_ls(
+            volume,
+            "/",
+            [
+                ".",
+                "..",
+                "lost+found",
+                "bin",
+                "boot",
+                "dev",
+                "etc",
+                "home",
+                "lib",
+                "media",
+                "mnt",
+                "postinst",
+                "proc",
+                "run",
+                "sbin",
+                "srv",
+                "sys",
+                "tmp",
+                "uboot-version",
+                "usr",
+                "var",
+            ],
+        )
+        assert_ls(
+            volume,
+            "/bin",
+            [
+                ".",
+                "..",
+                "rmdir",
+                "sed",
+                "chgrp",
+                "systemctl",
+                "bash.bash",
+                "mountpoint",
+                "chattr",
+                "stat",
+                "mount",
+                "busybox",
+                "systemd-sysext",
+                "networkctl",
+                "chown",
+                "systemd-tmpfiles",
+                "mktemp",
+                "lsmod",
+                "stty",
+                "kill",
+                "cpio",
+                "true",
+                "gzip",
+                "df",
+                "ps",
+                "systemd-sysusers",
+                "systemd-machine-id-setup",
+                "dnsdomainname",
+                "netstat",
+                "dumpkmap",
+                "su.shadow",
+                "systemd-tty-ask-password-agent",
+                "date",
+                "kmod",
+                "systemd-escape",
+                "ln",
+                "loginctl",
+                "watch",
+                "dmesg",
+                "uname",
+                "dd",
+                "chmod",
+                "busybox.nosuid",
+                "busybox.suid",
+                "usleep",
+                "umount.util-linux",
+                "cp",
+                "more",
+                "login",
+                "journalctl",
+                "ls",
+                "false",
+                "systemd-creds",
+                "ash",
+                "hostname",
+                "touch",
+                "base32",
+                "ping",
+                "sleep",
+                "pidof",
+                "systemd-inhibit",
+                "grep",
+                "tar",
+                "getopt",
+                "zcat",
+                "umount",
+                "egrep",
+                "mknod",
+                "rm",
+                "fgrep",
+                "cat",
+                "sh",
+                "pwd",
+                "vi",
+                "rev",
+                "mkdir",
+                "systemd-hwdb",
+                "gunzip",
+                "sync",
+                "login.shadow",
+                "lsmod.kmod",
+                "systemd-notify",
+                "systemd-ask-password",
+                "su",
+                "systemd-firstboot",
+                "mv",
+                "udevadm",
+                "bash",
+                "echo",
+                "mount.util-linux",
+                "run-parts",
+            ],
+        )
+        assert_symlink_to(volume, "/bin/ash", b"/bin/busybox.nosuid")
+
+    cache_size = 1
+    raw_cache_size = cache_size * 1024 * 1024
+    read_size = raw_cache_size + 1
+    with UpdateImage(path, cache_size=cache_size) as image:
+        print(
+            f"checking reading larger than {sizeof_fmt(raw_cache_size)} cache size: ",
+            end="",
+        )
+        try:
+            data = image.read(read_size)
+            data_size = len(data)
+            if data_size != read_size:
+                raise ValueError(
+                    f"data returned is not {sizeof_fmt(read_size)}: {sizeof_fmt(data_size)}"
+                )
+
             print("pass")
 
-        else:
-            print("fail")
+        except ValueError as e:
             FAILED = True
-            print(
-                f"  Unexpected error: {os.strerror(e.errno) if e.errno is not None else e}"
+            print("fail")
+            print("  ", end="")
+            print(e)
+
+    with UpdateImage(".data/2.13.0.758_reMarkable2-2N5B5nvpZ4-.signed") as image:
+        assert_image_type(image, ProtobufUpdateImage)
+        assert_no_attr(image, "version")
+        volume = ext4.Volume(image)
+        validate_root_inode(volume)
+        print("checking image signature: ", end="")
+        try:
+            image.verify(
+                volume.inode_at("/usr/share/update_engine/update-payload-key.pub.pem")
+                .open()
+                .read()
             )
+            print("pass")
+
+        except UpdateImageSignatureException:
+            print("fail")
+
+        assert_value("block count", volume.superblock.s_blocks_count, 261888)
+        assert_value("free block count", volume.superblock.s_free_blocks_count, 38220)
+        assert_value("inode count", volume.superblock.s_inodes_count, 65024)
+        assert_value("free inode count", volume.superblock.s_free_inodes_count, 56414)
+
+        inode = volume.inode_at("/bin/bash.bash")
+        with inode.open() as reader:
+            # Make sure that we aren't reading zeros where there should be a larger block of data
+            assert_byte(reader, 0x00020000, b"\x0c")
+            assert_byte(reader, 0x00020001, b"\x60")
+            assert_byte(reader, 0x00020002, b"\x9d")
+            # Make sure we return a non-zero where a kernel loopback would return data
+            assert_byte(reader, 0x000BBFFF, b"\xe5")
+            assert_byte(reader, 0x000BC000, b"\x54")
+
+        assert_exists(volume, "/bin/bash.bash")
+        assert_exists(volume, "/uboot-version")
+        assert_exists(volume, "/home/root")
+        assert_hash(volume, "21442141a3b145d11763862fcbecc40a", "/uboot-version")
+        assert_hash(volume, "233a2dc8f0ab70fbd956b036438adefb", "/bin/bash.bash")
+        assert_hash(
+            volume,
+            "6a67b9873c57fbb8589ef4a4f744beb3",
+            "/usr/share/update_engine/update-payload-key.pub.pem",
+        )
+        assert_ls(
+            volume,
+            "/",
+            [
+                ".",
+                "..",
+                "lost+found",
+                "bin",
+                "boot",
+                "dev",
+                "etc",
+                "home",
+                "lib",
+                "media",
+                "mnt",
+                "postinst",
+                "proc",
+                "run",
+                "sbin",
+                "sys",
+                "tmp",
+                "uboot-postinst",
+                "uboot-version",
+                "usr",
+                "var",
+            ],
+        )
+        assert_symlink_to(volume, "/bin/ash", b"/bin/busybox.nosuid")
+
+        print("checking path that contains file raises ENOTDIR: ", end="")
+        try:
+            _ = volume.inode_at("/uboot-version/test")
+            print("fail")
+            print("  No error raised")
+            FAILED = True
+
+        except OSError as e:
+            if e.errno == errno.ENOTDIR:
+                print("pass")
+
+            else:
+                print("fail")
+                FAILED = True
+                print(
+                    f"  Unexpected error: {os.strerror(e.errno) if e.errno is not None else e}"
+                )
+
+        assert_extract(
+            image,
+            "ca65563b992e6d38e539f0a837416b8078903d7490d63aa9f6a059e431918d88",
+        )
+        assert_extract_to(
+            image,
+            "ca65563b992e6d38e539f0a837416b8078903d7490d63aa9f6a059e431918d88",
+        )
+        assert_extract_to(
+            image,
+            "ca65563b992e6d38e539f0a837416b8078903d7490d63aa9f6a059e431918d88",
+            sparse=True,
+        )
+        assert_read_at_threads(
+            image,
+            "ca65563b992e6d38e539f0a837416b8078903d7490d63aa9f6a059e431918d88",
+        )
+
+        # Make sure we aren't reading zeros in the raw image where there should be data
+        assert_raw_byte(image, 0x00100000, b"\xed")
+        assert_raw_byte(image, 0x00100001, b"\x41")
+        assert_raw_byte(image, 0x00100002, b"\x00")
+        assert_readinto(image, 0x000FF000, 0x00100000)
+        assert_value(
+            "blobs verified",
+            all(image.verify_blobs(force=True).values()),  # pyright: ignore[reportAttributeAccessIssue]
+            True,
+        )
+
+    with TemporaryDirectory() as disk_cache:
+        for i in range(2):
+            with UpdateImage(
+                ".data/2.13.0.758_reMarkable2-2N5B5nvpZ4-.signed",
+                disk_cache=disk_cache,
+            ) as image:
+                assert_extract(
+                    image,
+                    "ca65563b992e6d38e539f0a837416b8078903d7490d63aa9f6a059e431918d88",
+                )
+                assert_value(
+                    "disk cache used",
+                    "disk_cache_hits" in image.stats(),
+                    i > 0,
+                )
+
+    with UpdateImage(
+        ".data/2.13.0.758_reMarkable2-2N5B5nvpZ4-.signed",
+        use_mmap=True,
+    ) as image:
+        assert_extract(
+            image,
+            "ca65563b992e6d38e539f0a837416b8078903d7490d63aa9f6a059e431918d88",
+        )
 
-    assert_extract(
-        image,
+    assert_async_read(
+        ".data/2.13.0.758_reMarkable2-2N5B5nvpZ4-.signed",
         "ca65563b992e6d38e539f0a837416b8078903d7490d63aa9f6a059e431918d88",
     )
 
-    # Make sure we aren't reading zeros in the raw image where there should be data
-    assert_raw_byte(image, 0x00100000, b"\xed")
-    assert_raw_byte(image, 0x00100001, b"\x41")
-    assert_raw_byte(image, 0x00100002, b"\x00")
-
-path = ".data/remarkable-production-memfault-image-3.20.0.92-rmpp-public"
-with UpdateImage(path) as image:
-    assert_image_type(image, CPIOUpdateImage)
-    assert_attr(image, "version", "3.20.0.92")
-    assert_attr(image, "hardware_type", "ferrari")
-    assert_in_archive(image, "sw-description")  # pyright: ignore[reportArgumentType]
-    volume = ext4.Volume(image)
-    validate_root_inode(volume)
-    assert_extract(
-        image,
-        "e8eec783c885df92d05dd53ba454949b6f0e5bd793038013df092786b54d6d5d",
+    path = ".data/remarkable-production-memfault-image-3.20.0.92-rmpp-public"
+    with UpdateImage(path) as image:
+        assert_image_type(image, CPIOUpdateImage)
+        assert_attr(image, "version", "3.20.0.92")
+        assert_attr(image, "hardware_type", "ferrari")
+        assert_in_archive(image, "sw-description")  # pyright: ignore[reportArgumentType]
+        with open(path, "rb") as f:
+            assert_value(
+                "streamed entries",
+                [x.name for x in iter_entries(f)],
+                list(image.archive.keys()),  # pyright: ignore[reportAttributeAccessIssue]
+            )
+
+        assert_value(
+            "primary image listed",
+            any(x is image for x in image.images.values()),  # pyright: ignore[reportAttributeAccessIssue]
+            True,
+        )
+        volume = ext4.Volume(image)
+        validate_root_inode(volume)
+        assert_extract(
+            image,
+            "e8eec783c885df92d05dd53ba454949b6f0e5bd793038013df092786b54d6d5d",
+        )
+        _ = image.seek(0, os.SEEK_SET)
+        assert_extract_to(image, sha256(image.read()).hexdigest(), sparse=True)
+
+    with TemporaryDirectory() as disk_cache:
+        for _ in range(2):
+            with UpdateImage(path, disk_cache=disk_cache) as image:
+                assert_image_type(image, CPIOUpdateImage)
+                volume = ext4.Volume(image)
+                validate_root_inode(volume)
+
+    with UpdateImage(path, use_mmap=True) as image:
+        assert_image_type(image, CPIOUpdateImage)
+        volume = ext4.Volume(image)
+        validate_root_inode(volume)
+
+    old = b"reMarkable update image"
+    new = b"reMarkable Update image!"
+    control = bz2.compress(struct.pack("<3Q", len(old), len(new) - len(old), 0))
+    diff = bz2.compress(bytes((a - b) & 0xFF for a, b in zip(new, old)))
+    extra = bz2.compress(new[len(old) :])
+    assert_value(
+        "bspatch result",
+        bsdiff.patch(
+            old,
+            b"BSDIFF40"
+            + struct.pack("<3Q", len(control), len(diff), len(new))
+            + control
+            + diff
+            + extra,
+        ),
+        new,
+    )
+
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    other_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    with TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "update.swu")
+        make_swu(path, make_image(1024 * 1024), private_key)
+        with UpdateImage(path) as image:
+            for signing_key, valid in ((private_key, True), (other_key, False)):
+                assert_verify(
+                    image,
+                    signing_key.public_key().public_bytes(
+                        Encoding.PEM, PublicFormat.SubjectPublicKeyInfo
+                    ),
+                    valid,
+                )
+
+    rnd = random.Random(1)  # noqa: S311
+    base = rnd.randbytes(4 * BLOCK_SIZE)
+    # Only the first src_length bytes of the src extents are given to bspatch
+    source = (base[3 * BLOCK_SIZE :] + base[:BLOCK_SIZE])[: BLOCK_SIZE + 100]
+    patched = rnd.randbytes(2 * BLOCK_SIZE)
+    replaced = rnd.randbytes(BLOCK_SIZE)
+    target = base[2 * BLOCK_SIZE : 3 * BLOCK_SIZE] + patched + replaced
+    with TemporaryDirectory() as tmp:
+        base_path = os.path.join(tmp, "base.signed")
+        write_payload(
+            base_path,
+            [
+                (
+                    InstallOperation(
+                        type=InstallOperation.REPLACE,
+                        dst_extents=[Extent(start_block=0, num_blocks=4)],
+                    ),
+                    base,
+                )
+            ],
+        )
+        path = os.path.join(tmp, "delta.signed")
+        write_payload(
+            path,
+            [
+                (
+                    InstallOperation(
+                        type=InstallOperation.MOVE,
+                        src_extents=[Extent(start_block=2, num_blocks=1)],
+                        dst_extents=[Extent(start_block=0, num_blocks=1)],
+                    ),
+                    b"",
+                ),
+                (
+                    InstallOperation(
+                        type=InstallOperation.BSDIFF,
+                        src_extents=[
+                            Extent(start_block=3, num_blocks=1),
+                            Extent(start_block=0, num_blocks=1),
+                        ],
+                        src_length=len(source),
+                        dst_extents=[Extent(start_block=1, num_blocks=2)],
+                        dst_length=len(patched),
+                    ),
+                    make_patch(source, patched),
+                ),
+                (
+                    InstallOperation(
+                        type=InstallOperation.REPLACE,
+                        dst_extents=[Extent(start_block=3, num_blocks=1)],
+                    ),
+                    replaced,
+                ),
+            ],
+        )
+        with (
+            UpdateImage(base_path) as base_image,
+            UpdateImage(path, base=base_image) as image,
+        ):
+            assert_image_type(image, ProtobufUpdateImage)
+            assert_value(
+                "delta read digest",
+                sha256(image.read()).hexdigest(),
+                sha256(target).hexdigest(),
+            )
+            assert_value(
+                "delta read_at",
+                image.read_at(BLOCK_SIZE - 10, 20).hex(),
+                target[BLOCK_SIZE - 10 : BLOCK_SIZE + 10].hex(),
+            )
+            assert_extract_to(image, sha256(target).hexdigest())
+
+        print("checking delta without a base image raises: ", end="")
+        with UpdateImage(path) as image:
+            try:
+                _ = image.read()
+                print("fail")
+                print("  No error raised")
+                FAILED = True
+
+            except UpdateImageException as e:
+                if "needs a base image" in str(e):
+                    print("pass")
+
+                else:
+                    print("fail")
+                    FAILED = True
+                    print(f"  Unexpected error: {e}")
+
+    scattered = rnd.randbytes(3 * BLOCK_SIZE)
+    short = rnd.randbytes(BLOCK_SIZE + 904)
+    last = rnd.randbytes(BLOCK_SIZE)
+    # Blocks 2 and 6 are not mapped, the end of block 4 is past the short blob
+    target = (
+        scattered[BLOCK_SIZE:]
+        + bytes(BLOCK_SIZE)
+        + short
+        + bytes(BLOCK_SIZE - 904)
+        + scattered[:BLOCK_SIZE]
+        + bytes(BLOCK_SIZE)
+        + last
+    )
+    with TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "extents.signed")
+        write_payload(
+            path,
+            [
+                (
+                    InstallOperation(
+                        type=InstallOperation.REPLACE_BZ,
+                        dst_extents=[
+                            Extent(start_block=5, num_blocks=1),
+                            Extent(start_block=SPARSE_HOLE, num_blocks=1),
+                            Extent(start_block=0, num_blocks=2),
+                        ],
+                    ),
+                    bz2.compress(
+                        scattered[:BLOCK_SIZE]
+                        + rnd.randbytes(BLOCK_SIZE)
+                        + scattered[BLOCK_SIZE:]
+                    ),
+                ),
+                (
+                    InstallOperation(
+                        type=InstallOperation.REPLACE,
+                        dst_extents=[Extent(start_block=3, num_blocks=2)],
+                    ),
+                    short,
+                ),
+                (
+                    InstallOperation(
+                        type=InstallOperation.REPLACE,
+                        dst_extents=[Extent(start_block=7, num_blocks=1)],
+                    ),
+                    last,
+                ),
+            ],
+        )
+        with UpdateImage(path) as image:
+            assert_value("extents size", image.size, len(target))
+            assert_value(
+                "extents read digest",
+                sha256(image.read()).hexdigest(),
+                sha256(target).hexdigest(),
+            )
+            for offset in (BLOCK_SIZE - 10, 5 * BLOCK_SIZE - 10, 4 * BLOCK_SIZE + 900):
+                assert_value(
+                    f"extents read_at {offset:08X}",
+                    sha256(image.read_at(offset, 2 * BLOCK_SIZE)).hexdigest(),
+                    sha256(target[offset : offset + 2 * BLOCK_SIZE]).hexdigest(),
+                )
+
+            assert_readinto(image, BLOCK_SIZE - 10, 3 * BLOCK_SIZE)
+            assert_readinto(image, 4 * BLOCK_SIZE + 900, 2 * BLOCK_SIZE)
+            assert_extract_to(image, sha256(target).hexdigest(), sparse=True)
+
+    cache = BlockCache(maxsize=3, policy="lru")
+    for key in range(3):
+        cache[key] = b"x"
+
+    _ = cache[0]
+    cache[3] = b"x"
+    assert_value("lru keys", sorted(cache), [0, 2, 3])
+
+    now = 0.0
+    cache = BlockCache(maxsize=10, ttl=5, timer=lambda: now)
+    cache[0] = b"a"
+    now = 3.0
+    cache[1] = b"b"
+    now = 6.0
+    assert_value("ttl expired key", 0 in cache, False)
+    assert_value("ttl live key", 1 in cache, True)
+    assert_value("ttl expire()", cache.expire(), [(0, b"a")])
+    assert_value("ttl size after expiry", cache.currsize, 1)
+
+    evicted: list[int] = []
+    cache = BlockCache(
+        maxsize=10, policy="lru", on_evict=lambda key, _: evicted.append(key)
     )
+    cache[0] = b"aaaa"
+    cache[1] = b"bbbb"
+    assert_value("cache size", cache.currsize, 8)
+    cache[0] = b"aa"
+    assert_value("cache size after replace", cache.currsize, 6)
+    cache[2] = b"ccccc"
+    assert_value("cache size after eviction", cache.currsize, 7)
+    assert_value("evicted keys", evicted, [1])
+    del cache[0]
+    assert_value("cache size after delete", cache.currsize, 5)
+    print("checking too large value raises ValueError: ", end="")
+    try:
+        cache[3] = bytes(11)
+        print("fail")
+        FAILED = True
+
+    except ValueError:
+        print("pass")
+
+    # Keys added again after being evicted are kept through a sequential scan
+    for policy, kept in (("2q", True), ("lru", False)):
+        cache = BlockCache(maxsize=8, policy=policy)
+        hot = range(4)
+        for scan in (range(100, 120), range(200, 220)):
+            for key in hot:
+                if key not in cache:
+                    cache[key] = b"x"
+
+            for key in scan:
+                cache[key] = b"x"
+
+        assert_value(
+            f"{policy} keeps re-referenced keys", all(x in cache for x in hot), kept
+        )
+
+    # ISIZE of a multi-member gzip stream only covers its last member
+    raw = make_image(3 * 1024 * 1024)
+    with TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "members.swu")
+        make_swu(path, raw, private_key, members=2)
+        with UpdateImage(path) as image:
+            offset = 2500000
+            assert_value("seek before indexing", image.seek(offset), offset)
+            assert_value(
+                "read before indexing",
+                image.read(16).hex(),
+                raw[offset : offset + 16].hex(),
+            )
+            assert_value("wait_indexed", image.wait_indexed(), True)  # pyright: ignore[reportAttributeAccessIssue]
+            assert_value("size after indexing", image.size, len(raw))
+            assert_value("seek to end", image.seek(0, os.SEEK_END), len(raw))
+
+        with UpdateImage(path) as image:
+            assert_value(
+                "multi-member read digest",
+                sha256(image.read()).hexdigest(),
+                sha256(raw).hexdigest(),
+            )
+
+    raw = make_image(1024 * 1024)
+    with TemporaryDirectory() as tmp:
+        for name in ("update.signed", "update.swu"):
+            path = os.path.join(tmp, name)
+            if name.endswith(".swu"):
+                make_swu(path, raw, private_key)
+
+            else:
+                make_crau(path, raw, private_key)
+
+            with UpdateImage(path) as image:
+                assert_value(
+                    f"{name} read_at past the end",
+                    len(image.read_at(0, 10**12)),
+                    len(raw),
+                )
+                assert_value(
+                    f"{name} read past the end",
+                    len(image.read(10**12)),
+                    len(raw),
+                )
+
+            assert_value(
+                f"{name} async read_at past the end",
+                len(asyncio.run(async_read_at(path, 4096, 10**12))),
+                len(raw) - 4096,
+            )
+
+    with TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "update.signed")
+        disk_cache = os.path.join(tmp, "cache")
+        make_crau(path, raw, private_key)
+        with UpdateImage(path, disk_cache=disk_cache) as image:
+            blobs = range(len(image.verify_blobs()))  # pyright: ignore[reportAttributeAccessIssue]
+
+        with UpdateImage(path, disk_cache=disk_cache) as image:
+            assert_value(
+                "ledger loaded",
+                all(image.is_verified(x) for x in blobs),  # pyright: ignore[reportAttributeAccessIssue]
+                True,
+            )
+            assert_value(
+                "ledger read digest",
+                sha256(image.read()).hexdigest(),
+                sha256(raw).hexdigest(),
+            )
+            assert_value("ledger skips sha256", "sha256_time" in image.stats(), False)
+
+        stat = os.stat(path)
+        os.utime(path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+        with UpdateImage(path, disk_cache=disk_cache) as image:
+            assert_value(
+                "ledger of a changed file",
+                any(image.is_verified(x) for x in blobs),  # pyright: ignore[reportAttributeAccessIssue]
+                False,
+            )
+
+    raw = make_image(8 * 1024 * 1024)
+    with TemporaryDirectory() as tmp:
+        for name in ("update.signed", "update.swu"):
+            path = os.path.join(tmp, name)
+            if name.endswith(".swu"):
+                make_swu(path, raw, private_key)
+
+            else:
+                make_crau(path, raw, private_key)
+
+            for readahead in (4, 0):
+                with UpdateImage(path, readahead=readahead) as image:
+                    hasher = sha256()
+                    while data := image.read(64 * 1024):
+                        hasher.update(data)
+
+                    assert_value(
+                        f"{name} readahead={readahead} read digest",
+                        hasher.hexdigest(),
+                        sha256(raw).hexdigest(),
+                    )
+                    assert_value(
+                        f"{name} readahead={readahead} used",
+                        "readahead" in image.stats(),
+                        readahead > 0,
+                    )
+
+            with UpdateImage(path) as image:
+                for _ in range(4):
+                    _ = image.read(64 * 1024)
+
+                assert_value(
+                    f"{name} readahead queued",
+                    "readahead" in image.stats(),
+                    True,
+                )
+
+            assert_value(f"{name} closed with readahead queued", image.closed, True)
+
+    with TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "update.signed")
+        make_crau(path, raw, private_key)
+        with UpdateImage(path, cache_size=1, readahead=0) as image:
+            seen: dict[str, float] = {}
+
+            def hook(name: str, amount: float, _blob: int | None) -> None:
+                seen[name] = seen.get(name, 0) + amount
+
+            image.add_hook(hook)
+            while image.read(64 * 1024):
+                pass
+
+            _ = image.read_at(0, 4096)
+            _ = image.read_at(0, 4096)
+            stats = image.stats()
+            blobs = cast(dict[int, dict[str, float]], stats.pop("blobs"))
+            totals = cast(dict[str, float], stats)
+            assert_value("hook saw every stat", seen, totals)
+            for name in ("cache_hits", "cache_misses", "cache_evictions", "bytes_read"):
+                assert_value(f"{name} counted", totals.get(name, 0) > 0, True)
+
+            assert_value(
+                "per blob bytes_read",
+                sum(x.get("bytes_read", 0) for x in blobs.values()),
+                totals["bytes_read"],
+            )
+            image.remove_hook(hook)
+            image.reset_stats()
+            assert_value("stats reset", image.stats(), {"blobs": {}})
+            _ = image.read_at(len(raw) // 2, 4096)
+            assert_value("hook removed", seen == totals, True)
+
+        calls: list[tuple[int, int]] = []
+        with ProtobufUpdateImage(path) as image:
+            image.verify(
+                private_key.public_key().public_bytes(
+                    Encoding.PEM, PublicFormat.SubjectPublicKeyInfo
+                ),
+                progress=lambda done, total, _elapsed: calls.append((done, total)),
+                chunk_size=256 * 1024,
+            )
+
+        total = calls[-1][1]
+        assert_value("verify progress calls", len(calls), -(-total // (256 * 1024)))
+        assert_value("verify progress ends at total", calls[-1], (total, total))
+        assert_value(
+            "verify progress increases",
+            all(a[0] < b[0] for a, b in pairwise(calls)),
+            True,
+        )
+
+    other = make_image(1024 * 1024, seed=3)
+    with TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "update.swu")
+        make_swu(path, raw, private_key, other=other)
+        with CPIOUpdateImage(path) as image:
+            second = image.images["stable", "copy1", "other.ext4.gz"]
+            assert_value("second image", second is image, False)
+            assert_value(
+                "second image shared",
+                image.images["stable", "copy2", "other.ext4.gz"] is second,
+                True,
+            )
+            assert_value("second image not opened", second._image is None, True)  # pyright: ignore[reportPrivateUsage]
+            assert_value("second image not indexed", second._indexed.is_set(), False)  # pyright: ignore[reportPrivateUsage]
+            assert_value(
+                "second image read digest",
+                sha256(second.read()).hexdigest(),
+                sha256(other).hexdigest(),
+            )
+            assert_value("second image opened", second._image is not None, True)  # pyright: ignore[reportPrivateUsage]
+            assert_value(
+                "primary image read digest",
+                sha256(image.read()).hexdigest(),
+                sha256(raw).hexdigest(),
+            )
 
-if FAILED:
-    sys.exit(1)
+    if FAILED:
+        sys.exit(1)